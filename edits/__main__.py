@@ -0,0 +1,181 @@
+# Copyright 2017-2020 Palantir Technologies, Inc.
+# Copyright 2021- Python Language Server Contributors.
+
+import argparse
+import logging
+import logging.config
+import sys
+import time
+
+try:
+    import ujson as json
+except Exception:
+    import json
+
+from ._version import __version__
+from .python_lsp import (
+    PythonLSPServer,
+    start_io_lang_server,
+    start_tcp_lang_server,
+    start_ws_lang_server,
+)
+
+LOG_FORMAT = "%(asctime)s {0} - %(levelname)s - %(name)s - %(message)s".format(
+    time.localtime().tm_zone
+)
+
+
+def add_arguments(parser):
+    parser.description = "Python Language Server"
+
+    parser.add_argument(
+        "--tcp", action="store_true", help="Use TCP server instead of stdio"
+    )
+    parser.add_argument(
+        "--ws", action="store_true", help="Use Web Sockets server instead of stdio"
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Bind to this address")
+    parser.add_argument("--port", type=int, default=2087, help="Bind to this port")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes serving Web Sockets sessions, 0 for one per core",
+    )
+    parser.add_argument(
+        "--max-worker-memory",
+        type=int,
+        help="Replace Web Sockets worker processes using more memory than this, "
+        "in MB",
+    )
+    parser.add_argument(
+        "--session-idle-timeout",
+        type=int,
+        help="Close Web Sockets sessions idle for this many seconds, shedding their "
+        "caches halfway",
+    )
+    parser.add_argument(
+        "--session-max-memory",
+        type=int,
+        help="Close Web Sockets sessions holding more than this many MB once their "
+        "caches are shed",
+    )
+    parser.add_argument(
+        "--session-resume-ttl",
+        type=int,
+        help="Let clients resume Web Sockets sessions that ended without a shutdown "
+        "for this many seconds",
+    )
+    parser.add_argument(
+        "--analysis-processes",
+        type=int,
+        default=0,
+        help="Run pyflakes checks in this many processes of each Web Sockets "
+        "worker, 0 to run them in the worker",
+    )
+    parser.add_argument(
+        "--check-parent-process",
+        action="store_true",
+        help="Check whether parent process is still alive using os.kill(ppid, 0) "
+        "and auto shut down language server process when parent process is not alive."
+        "Note that this may not work on a Windows machine.",
+    )
+
+    log_group = parser.add_mutually_exclusive_group()
+    log_group.add_argument(
+        "--log-config", help="Path to a JSON file containing Python logging config."
+    )
+    log_group.add_argument(
+        "--log-file",
+        help="Redirect logs to the given file instead of writing to stderr."
+        "Has no effect if used with --log-config.",
+    )
+
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="count",
+        default=0,
+        help="Increase verbosity of log output, overrides log config file",
+    )
+
+    parser.add_argument(
+        "-V", "--version", action="version", version="%(prog)s v" + __version__
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+    _configure_logger(args.verbose, args.log_config, args.log_file)
+
+    if args.tcp:
+        start_tcp_lang_server(
+            args.host, args.port, args.check_parent_process, PythonLSPServer
+        )
+    elif args.ws:
+        start_ws_lang_server(
+            args.port,
+            args.check_parent_process,
+            PythonLSPServer,
+            workers=args.workers,
+            max_worker_memory=_megabytes(args.max_worker_memory),
+            session_idle_timeout=args.session_idle_timeout,
+            session_max_memory=_megabytes(args.session_max_memory),
+            session_resume_ttl=args.session_resume_ttl,
+            analysis_processes=args.analysis_processes,
+        )
+    else:
+        stdin, stdout = _binary_stdio()
+        start_io_lang_server(stdin, stdout, args.check_parent_process, PythonLSPServer)
+
+
+def _megabytes(value):
+    return None if value is None else value * 1024 * 1024
+
+
+def _binary_stdio():
+    """Construct binary stdio streams (not text mode).
+
+    This seems to be different for Window/Unix Python2/3, so going by:
+        https://stackoverflow.com/questions/2850893/reading-binary-data-from-stdin
+    """
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    return stdin, stdout
+
+
+def _configure_logger(verbose=0, log_config=None, log_file=None):
+    root_logger = logging.root
+
+    if log_config:
+        with open(log_config, "r", encoding="utf-8") as f:
+            logging.config.dictConfig(json.load(f))
+    else:
+        formatter = logging.Formatter(LOG_FORMAT)
+        if log_file:
+            log_handler = logging.handlers.RotatingFileHandler(
+                log_file,
+                mode="a",
+                maxBytes=50 * 1024 * 1024,
+                backupCount=10,
+                encoding=None,
+                delay=0,
+            )
+        else:
+            log_handler = logging.StreamHandler()
+        log_handler.setFormatter(formatter)
+        root_logger.addHandler(log_handler)
+
+    if verbose == 0:
+        level = logging.WARNING
+    elif verbose == 1:
+        level = logging.INFO
+    elif verbose >= 2:
+        level = logging.DEBUG
+
+    root_logger.setLevel(level)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+# Copyright 2021- Python Language Server Contributors.
+
+"""Cancellation of work whose result is no longer needed.
+
+Cancellable requests and lints run with a `Token`, current for the thread
+running them. The token is cancelled by ``$/cancelRequest`` for a request,
+and by the next change of the document for a lint. Plugins call `check`
+between the stages of long work, which raises `RequestCancelled` once the
+token is cancelled, and stop work running outside of the thread, like a
+subprocess, with `on_cancel`.
+"""
+
+import contextlib
+import logging
+import threading
+
+from pylsp_jsonrpc.endpoint import Endpoint
+from pylsp_jsonrpc.exceptions import JsonRpcMethodNotFound, JsonRpcRequestCancelled
+
+from pylsp import _scheduler
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class RequestCancelled(Exception):
+    """Raised by `check` in cancelled work."""
+
+
+class Token:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._callbacks = []
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def cancel(self):
+        with self._lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            _call(callback)
+
+    def check(self):
+        if self._cancelled:
+            raise RequestCancelled()
+
+    def add_callback(self, callback):
+        """Call `callback` once the token is cancelled, right away if it is."""
+        with self._lock:
+            if not self._cancelled:
+                self._callbacks.append(callback)
+                return
+        _call(callback)
+
+    def remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+def _call(callback):
+    try:
+        callback()
+    except Exception:  # pylint: disable=broad-except
+        log.exception("Failed to run cancellation callback %s", callback)
+
+
+@contextlib.contextmanager
+def use(token):
+    """Make `token` the current token of the thread."""
+    previous = current()
+    _local.token = token
+    try:
+        yield token
+    finally:
+        _local.token = previous
+
+
+def current():
+    return getattr(_local, "token", None)
+
+
+def check():
+    """Raise `RequestCancelled` if the current work was cancelled.
+
+    Background work also pauses here once while more urgent requests run.
+    """
+    _scheduler.SCHEDULER.yield_to_urgent()
+    token = current()
+    if token is not None:
+        token.check()
+
+
+@contextlib.contextmanager
+def on_cancel(callback):
+    """Call `callback` if the current work is cancelled within this block."""
+    token = current()
+    if token is None:
+        yield
+        return
+    token.add_callback(callback)
+    try:
+        yield
+    finally:
+        token.remove_callback(callback)
+
+
+def result(future, timeout=None):
+    """Wait for `future` like `future.result`, unless the current work is cancelled.
+
+    Raises `RequestCancelled` once the current token is cancelled, leaving
+    `future` to its owner.
+    """
+    done = threading.Event()
+    future.add_done_callback(lambda _future: done.set())
+    with on_cancel(done.set):
+        done.wait(timeout)
+    check()
+    return future.result(timeout=0)
+
+
+class CancellableEndpoint(Endpoint):
+    """Endpoint running requests on the scheduler, by the class in `PRIORITIES`.
+
+    Scheduled requests are answered once done, and the following messages,
+    like ``$/cancelRequest`` or a change of the document, are handled while
+    they run. A cancelled request is answered with a RequestCancelled error.
+    Other requests, like formatting, run right away on the thread reading the
+    messages, as their result depends on the messages before them, and
+    waiting for the process wide queues would hold up the whole session.
+    """
+
+    PRIORITIES = {
+        "textDocument/completion": "interactive",
+        "completionItem/resolve": "interactive",
+        "textDocument/hover": "interactive",
+        "textDocument/signatureHelp": "interactive",
+        "textDocument/definition": "interactive",
+        "textDocument/documentHighlight": "interactive",
+        "textDocument/diagnostic": "diagnostics",
+        "textDocument/references": "workspace",
+        "textDocument/documentSymbol": "workspace",
+    }
+
+    def __init__(self, *args, scheduler=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._scheduler = scheduler or _scheduler.SCHEDULER
+        self._tokens = {}
+
+    def _handle_request(self, msg_id, method, params):
+        priority = self.PRIORITIES.get(method)
+        if priority is None:
+            super()._handle_request(msg_id, method, params)
+            return
+        try:
+            handler = self._dispatcher[method]
+        except KeyError as e:
+            raise JsonRpcMethodNotFound.of(method) from e
+
+        def call():
+            handler_result = handler(params)
+            # Like the base endpoint, run handlers answering with a callable
+            return handler_result() if callable(handler_result) else handler_result
+
+        token = self._tokens[msg_id] = Token()
+
+        def run():
+            try:
+                with use(token):
+                    token.check()
+                    return call()
+            except RequestCancelled:
+                log.debug("Cancelled request %s %s", method, msg_id)
+                return {"error": JsonRpcRequestCancelled().to_dict()}
+            finally:
+                self._tokens.pop(msg_id, None)
+
+        request_future = self._scheduler.submit(priority, run)
+        self._client_request_futures[msg_id] = request_future
+        request_future.add_done_callback(self._request_callback(msg_id))
+
+    def _handle_cancel_notification(self, msg_id):
+        token = self._tokens.pop(msg_id, None)
+        if token is None:
+            super()._handle_cancel_notification(msg_id)
+            return
+        # Running requests stop at their next check, queued ones right away
+        log.debug("Cancelling request %s", msg_id)
+        token.cancel()
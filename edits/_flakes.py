@@ -0,0 +1,281 @@
+# Copyright 2021- Python Language Server Contributors.
+
+"""Incremental pyflakes checks, reusing the results of unchanged functions.
+
+Most of a pyflakes pass is spent in the bodies of the functions, which it
+defers until the module level is done. `IncrementalChecker` still walks the
+module level, but replays the messages of a function body checked before
+when its text and the bindings of the module and class names it mentions are
+unchanged. The cached unit is a function defined at the module level or in a
+class defined there, as statements of the module level bind the names the
+functions see and take little time to check.
+
+A body is only cached when checking it has no effect on the rest of the
+module besides using names of it: bodies nesting functions, lambdas, classes
+or deferred annotations, declaring ``global`` or ``nonlocal``, or shadowing
+imports of the module are always checked, as are modules importing ``*``.
+The messages are the ones of a full pass.
+
+`REPORTS` keeps the diagnostics of whole sources, so that a source linted
+again unchanged, e.g. on save or in another session starting from the same
+template, is not checked at all.
+"""
+
+import ast
+import collections
+import functools
+import os
+import re
+import threading
+
+from pyflakes import checker, messages
+
+from pylsp import _metrics
+
+# Function bodies kept, shared by all the documents of the process
+MAX_FUNCTIONS = 4096
+# Diagnostics of whole sources kept, shared by all the sessions of the process
+MAX_REPORTS = 256
+
+FUNCTION_TYPES = (ast.FunctionDef, ast.AsyncFunctionDef)
+
+RE_WORD = re.compile(r"[^\W\d]\w*")
+
+# Words of bodies changing the scopes of the module
+_UNCACHEABLE_WORDS = frozenset(("global", "nonlocal"))
+
+# Messages whose second argument is the line of another binding, if any
+_LINE_ARG_MESSAGES = (
+    messages.RedefinedWhileUnused,
+    messages.ImportShadowedByLoopVar,
+    messages.UndefinedLocal,
+)
+
+# Marks the names used by a replayed body. No scope is the replayed one.
+_REPLAYED_USE = (None, None)
+
+
+class LRUCache:
+    """A bounded mapping dropping its least recently used entries first."""
+
+    def __init__(self, max_entries):
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Messages of function bodies, by body and bindings
+FUNCTIONS = LRUCache(MAX_FUNCTIONS)
+# Diagnostics of pyflakes_lint, by source and Patch API names
+REPORTS = LRUCache(MAX_REPORTS)
+
+
+class IncrementalChecker(checker.Checker):
+    """A pyflakes checker replaying the unchanged function bodies of `lines`."""
+
+    def __init__(self, tree, lines, cache=FUNCTIONS, **kwargs):
+        self._lines = lines
+        self._cache = cache
+        self.replayed = 0
+        self.checked = 0
+        super().__init__(tree, **kwargs)
+
+    def LAMBDA(self, node):
+        super().LAMBDA(node)
+        if not isinstance(node, FUNCTION_TYPES) or not self._caches_scope(node):
+            return
+        # The body is the last deferred handler, run in the scopes of the def
+        handler, scope_stack, offset = self._deferred.pop()
+        self._deferred.append(
+            (functools.partial(self._run_body, node, handler), scope_stack, offset)
+        )
+
+    def _caches_scope(self, node):
+        """Whether `node` is defined at the module level or in a class there."""
+        if self.withDoctest:
+            return False
+        parent = node._pyflakes_parent
+        if isinstance(parent, ast.ClassDef):
+            parent = parent._pyflakes_parent
+        return parent is self.root and isinstance(
+            self.scopeStack[0], checker.ModuleScope
+        )
+
+    def _run_body(self, node, handler):
+        first, last = node.lineno, node.end_lineno
+        text = "".join(self._lines[first - 1 : last])
+        words = set(RE_WORD.findall(text))
+        if self.scopeStack[0].importStarred or words & _UNCACHEABLE_WORDS:
+            self.checked += 1
+            handler()
+            return
+
+        names, bindings = self._outer_bindings(words)
+        key = (
+            text,
+            tuple(type(scope).__name__ for scope in self.scopeStack),
+            self.annotationsFutureEnabled,
+            # pyflakes accepts __path__ in the __init__.py of packages
+            os.path.basename(self.filename) == "__init__.py",
+            bindings,
+        )
+        entry = self._cache.get(key)
+        if entry is not None:
+            self._replay(entry, first)
+            return
+
+        self.checked += 1
+        entry = self._record(handler, names, first, last)
+        if entry is not None:
+            self._cache.put(key, entry)
+
+    def _outer_bindings(self, words):
+        """Return the names of `words` bound outside the body, and their bindings.
+
+        The bindings are described by their scope and kind, which is all the
+        body depends on. Aliased imports also use their full name.
+        """
+        names = set()
+        for scope in self.scopeStack:
+            for word in words & scope.keys():
+                names.add(word)
+                binding = scope[word]
+                if isinstance(binding, checker.Importation) and binding._has_alias():
+                    names.add(binding.fullName)
+
+        bindings = []
+        for index, scope in enumerate(self.scopeStack):
+            for name in names:
+                binding = scope.get(name)
+                if binding is not None:
+                    bindings.append(
+                        (
+                            index,
+                            name,
+                            type(binding).__name__,
+                            getattr(binding, "fullName", None),
+                        )
+                    )
+        return names, tuple(sorted(bindings))
+
+    def _record(self, handler, names, first, last):
+        """Check the body with `handler`, returning its entry if it can be cached."""
+        outer = [
+            (index, name, scope[name])
+            for index, scope in enumerate(self.scopeStack)
+            for name in names
+            if name in scope
+        ]
+        uses = [binding.used for _index, _name, binding in outer]
+        redefined = [
+            len(getattr(binding, "redefined", ())) for _index, _name, binding in outer
+        ]
+        n_messages = len(self.messages)
+        n_dead = len(self.deadScopes)
+        n_deferred = len(self._deferred)
+
+        handler()
+
+        if len(self._deferred) != n_deferred or redefined != [
+            len(getattr(binding, "redefined", ())) for _index, _name, binding in outer
+        ]:
+            return None
+
+        # The scopes of the body only hold its own names, so they are reported
+        # on now, as a full pass would at its end
+        dead = self.deadScopes[n_dead:]
+        del self.deadScopes[n_dead:]
+        self.deadScopes, outer_dead = dead, self.deadScopes
+        try:
+            self.checkDeadScopes()
+        finally:
+            self.deadScopes = outer_dead
+
+        reported = []
+        for message in self.messages[n_messages:]:
+            attributes = dict(vars(message))
+            del attributes["filename"], attributes["lineno"], attributes["col"]
+            line_arg = None
+            if isinstance(message, _LINE_ARG_MESSAGES):
+                line_arg = _line_arg(message.message_args, first, last)
+                if line_arg is None:
+                    return None
+            offset = message.lineno - first
+            reported.append((type(message), offset, message.col, attributes, line_arg))
+        used = tuple(
+            (index, name)
+            for (index, name, binding), before in zip(outer, uses)
+            if binding.used is not before
+        )
+        return tuple(reported), used
+
+    def _replay(self, entry, first):
+        self.replayed += 1
+        reported, used = entry
+        for message_class, offset, col, attributes, line_arg in reported:
+            message = message_class.__new__(message_class)
+            vars(message).update(attributes)
+            message.filename = self.filename
+            message.lineno = first + offset
+            message.col = col
+            if line_arg is not None:
+                name, _lineno, *rest = message.message_args
+                message.message_args = (name, first + line_arg, *rest)
+            self.messages.append(message)
+        for index, name in used:
+            self.scopeStack[index][name].used = _REPLAYED_USE
+
+
+def _line_arg(message_args, first, last):
+    """Return the offset in the body of the other binding of a message, or None.
+
+    Messages about a binding outside of the body, or about a builtin, whose
+    arguments are only its name, are not cached.
+    """
+    if not isinstance(message_args, tuple) or len(message_args) < 2:
+        return None
+    lineno = message_args[1]
+    if isinstance(lineno, int) and first <= lineno <= last:
+        return lineno - first
+    return None
+
+
+def check(parsed, filename, reporter):
+    """Check `parsed` like `pyflakes.api.check`, replaying unchanged bodies.
+
+    `parsed` is the `Snapshot` of the source, whose ast tree is reused.
+    """
+    try:
+        tree = parsed.ast()
+    except SyntaxError as e:
+        reporter.syntaxError(filename, e.args[0], e.lineno, e.offset, e.text)
+        return 1
+    except Exception:  # pylint: disable=broad-except
+        reporter.unexpectedError(filename, "problem decoding source")
+        return 1
+
+    w = IncrementalChecker(tree, parsed.lines, filename=filename)
+    _metrics.increment("pyflakes.bodies_replayed", w.replayed)
+    _metrics.increment("pyflakes.bodies_checked", w.checked)
+    w.messages.sort(key=lambda m: m.lineno)
+    for warning in w.messages:
+        reporter.flake(warning)
+    return len(w.messages)
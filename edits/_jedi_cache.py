@@ -0,0 +1,149 @@
+# Copyright 2021- Python Language Server Contributors.
+
+"""Parse caches of jedi prebuilt ahead of time.
+
+Jedi keeps the parso trees of the modules it infers as pickles in its cache
+directory. A fresh container starts with an empty one, so `prebuild` parses
+the standard library, the installed packages and typeshed into a prebuilt
+directory, e.g. while building the image.
+
+The prebuilt directory is only ever read. `use` links its pickles into the
+writable cache directory of jedi, which also receives the pickles of any
+other module. Pickles older than their module are not linked, so that parso
+never writes through a link.
+"""
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+import jedi
+import parso
+from parso import cache as parso_cache
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PREBUILT_DIR = os.path.join(sys.prefix, "share", "pylsp", "jedi_cache")
+
+# Maps the pickle file names to the paths of their modules
+MANIFEST = "manifest.json"
+
+# Directories not worth parsing ahead of time
+SKIPPED_DIRS = {"__pycache__", "test", "tests", "idlelib", "turtledemo"}
+
+# pylint: disable-next=protected-access
+_VERSION_TAG = parso_cache._VERSION_TAG
+
+_lock = threading.Lock()
+_seeded = set()
+
+
+def use(cache_dir=None, prebuilt_dir=DEFAULT_PREBUILT_DIR):
+    """Point jedi at `cache_dir`, seeded with the pickles of `prebuilt_dir`.
+
+    Like the other jedi settings, the cache directory is process wide.
+    """
+    if cache_dir:
+        jedi.settings.cache_directory = os.path.expanduser(cache_dir)
+    if not prebuilt_dir:
+        return
+
+    key = (jedi.settings.cache_directory, prebuilt_dir)
+    with _lock:
+        if key in _seeded:
+            return
+        _seeded.add(key)
+        _seed(Path(prebuilt_dir), Path(jedi.settings.cache_directory))
+
+
+def _seed(prebuilt_dir, cache_dir):
+    source_dir = prebuilt_dir / _VERSION_TAG
+    try:
+        with open(source_dir / MANIFEST, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        log.debug("No prebuilt jedi cache in %s", source_dir)
+        return
+    except (OSError, ValueError) as e:
+        log.warning("Could not read the prebuilt jedi cache in %s: %s", source_dir, e)
+        return
+
+    start = time.perf_counter()
+    target_dir = cache_dir / _VERSION_TAG
+    linked = 0
+    try:
+        target_dir.mkdir(parents=True, exist_ok=True)
+        for name, module_path in manifest.items():
+            pickle_path = source_dir / name
+            try:
+                if os.path.getmtime(module_path) > os.path.getmtime(pickle_path):
+                    continue
+                os.symlink(pickle_path, target_dir / name)
+                linked += 1
+            except (FileNotFoundError, FileExistsError):
+                continue
+    except OSError as e:
+        log.warning("Could not seed the jedi cache in %s: %s", target_dir, e)
+    log.info(
+        "Linked %d prebuilt jedi cache entries in %.0f ms",
+        linked,
+        (time.perf_counter() - start) * 1000,
+    )
+
+
+def prebuild(prebuilt_dir=DEFAULT_PREBUILT_DIR, sys_path=None):
+    """Parse the modules of `sys_path` and typeshed into `prebuilt_dir`."""
+    start = time.perf_counter()
+    grammar = jedi.get_default_environment().get_grammar()
+    # pylint: disable-next=protected-access
+    hashed_grammar = grammar._hashed
+    cache_path = Path(prebuilt_dir)
+    typeshed_dir = os.path.join(os.path.dirname(jedi.__file__), "third_party")
+    roots = list(sys.path if sys_path is None else sys_path) + [typeshed_dir]
+
+    manifest = {}
+    for path in _module_paths(roots):
+        try:
+            grammar.parse(path=path, cache=True, cache_path=cache_path)
+        except (OSError, UnicodeDecodeError, RecursionError) as e:
+            log.debug("Could not parse %s: %s", path, e)
+            continue
+        # pylint: disable-next=protected-access
+        pickle_path = parso_cache._get_hashed_path(
+            hashed_grammar, path, cache_path=cache_path
+        )
+        manifest[os.path.basename(pickle_path)] = path
+        # Only keep the last trees in memory
+        parso_cache.parser_cache.clear()
+
+    with open(cache_path / _VERSION_TAG / MANIFEST, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    log.info(
+        "Prebuilt %d jedi cache entries for parso %s in %.0f s",
+        len(manifest),
+        parso.__version__,
+        time.perf_counter() - start,
+    )
+    return len(manifest)
+
+
+def _module_paths(roots):
+    seen = set()
+    for root in roots:
+        if not root or not os.path.isdir(root):
+            continue
+        for dirpath, dirnames, filenames in os.walk(root):
+            if dirpath in seen:
+                dirnames[:] = []
+                continue
+            seen.add(dirpath)
+            dirnames[:] = [
+                d for d in dirnames if d not in SKIPPED_DIRS and not d.startswith(".")
+            ]
+            for filename in filenames:
+                if filename.endswith((".py", ".pyi")):
+                    yield os.path.join(dirpath, filename)
@@ -0,0 +1,32 @@
+# Copyright 2021- Python Language Server Contributors.
+
+"""Process wide server metrics.
+
+Plugins record gauges (current values) and counters (running totals) here by
+dotted name, e.g. ``jedi_completion.resolve_at_most``. The server returns a
+snapshot of them for the custom ``pylsp/metrics`` request.
+"""
+
+import threading
+
+_lock = threading.Lock()
+_gauges = {}
+_counters = {}
+
+
+def set_gauge(name, value):
+    """Record the current value of `name`."""
+    with _lock:
+        _gauges[name] = value
+
+
+def increment(name, value=1):
+    """Add `value` to the running total of `name`."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def snapshot():
+    """Return a copy of all the recorded metrics."""
+    with _lock:
+        return {"gauges": dict(_gauges), "counters": dict(_counters)}
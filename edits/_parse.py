@@ -0,0 +1,224 @@
+# Copyright 2021- Python Language Server Contributors.
+
+"""Immutable snapshots of the versions of a document, and their parse artifacts.
+
+`Document.snapshot` returns the `Snapshot` of the current version of the
+document. A change of the document publishes a new snapshot rather than
+changing the current one, so background work holds the snapshot it started
+from without locking, and checks its result against the snapshot version.
+
+The `ast` tree and parso module of a snapshot are built on first use, so the
+plugins linting or completing the same version parse it once. The artifacts
+must not be mutated by their users, besides the links to their parents
+pyflakes sets on the ast nodes.
+
+Jedi keeps its own tree of the source, followed by the Patch API import, and
+updates it in place as the document changes; it is counted as one parse per
+version it is built for. Jedi finds the tree in parso's cache by path, the
+same for every session opening the document, so each session keeps its own
+tree out of the cache: `put_jedi_trees` caches it while the session holds
+the `jedi_path_lock` of the path, and `take_jedi_trees` takes it back.
+Scripts inferring in the background, where the next script of the document
+would update the tree under them, are created by
+`Snapshot.detached_jedi_script` on a tree of their version.
+
+Each parse is counted in the ``parse.<kind>`` counters, each reuse of an
+artifact in ``parse.reused``. The ``parse.per_version`` gauge holds the
+parses done for the last replaced version analysed, i.e. per keystroke while
+typing.
+"""
+
+import ast
+import itertools
+import threading
+import weakref
+from pathlib import Path
+
+import jedi
+import parso
+from parso import cache as parso_cache
+
+from pylsp import _metrics
+
+# Bytes held by the trees of a source per character, roughly, as measured on
+# the standard library
+AST_BYTES_PER_CHAR = 28
+PARSO_BYTES_PER_CHAR = 56
+
+# Held while jedi uses the tree of a document, by the paths hashing to each
+# lock. Reentrant, for the scripts created within a request.
+_JEDI_PATH_LOCKS = tuple(threading.RLock() for _ in range(16))
+# Numbers the paths of the trees detached from their document
+_DETACHED_IDS = itertools.count()
+
+
+class Snapshot:
+    """The source of one version of a document, never changed once created."""
+
+    def __init__(self, source, version=None):
+        self.source = source
+        self.version = version
+        self._lock = threading.Lock()
+        self._lines = None
+        self._ast = None
+        self._ast_error = None
+        self._parso_module = None
+        # Detached trees of jedi, by the code parsed
+        self._jedi_trees = {}
+        self._parses = set()
+
+    @property
+    def lines(self):
+        if self._lines is None:
+            self._lines = self.source.splitlines(True)
+        return self._lines
+
+    def memory_estimate(self):
+        """Estimate the bytes held by the source and the artifacts built of it."""
+        length = len(self.source)
+        size = length
+        if self._lines is not None:
+            size += length
+        if self._ast is not None:
+            size += length * AST_BYTES_PER_CHAR
+        if self._parso_module is not None:
+            size += length * PARSO_BYTES_PER_CHAR
+        for tree in list(self._jedi_trees.values()):
+            size += jedi_tree_estimate(tree.path)
+        return size
+
+    @property
+    def parses(self):
+        """Number of parses done for this version."""
+        return len(self._parses)
+
+    def ast(self):
+        """Return the `ast` tree of the source, raising its SyntaxError if any."""
+        with self._lock:
+            if self._ast is None and self._ast_error is None:
+                try:
+                    self._ast = ast.parse(self.source)
+                except (SyntaxError, ValueError) as e:
+                    self._ast_error = e
+                self._count("ast")
+            else:
+                _metrics.increment("parse.reused")
+        if self._ast_error is not None:
+            raise self._ast_error.with_traceback(None)
+        return self._ast
+
+    def parso_module(self):
+        """Return the parso module of the source, with error recovery."""
+        with self._lock:
+            if self._parso_module is None:
+                self._parso_module = parso.parse(self.source)
+                self._count("parso")
+            else:
+                _metrics.increment("parse.reused")
+            return self._parso_module
+
+    def note_jedi_parse(self):
+        """Count the parse of this version by jedi, once."""
+        with self._lock:
+            if "jedi" not in self._parses:
+                self._count("jedi")
+
+    def detached_jedi_script(self, code, path, **kwargs):
+        """Return a jedi script of `code` inferring on a tree of its own.
+
+        The tree is parsed once for the scripts of the same code, and no
+        script of another version updates it while they infer.
+        """
+        with self._lock:
+            tree = self._jedi_trees.get(code)
+            if tree is None:
+                tree = self._jedi_trees[code] = _DetachedTree(path)
+                self._count("jedi")
+            else:
+                _metrics.increment("parse.reused")
+        return tree.script(code, **kwargs)
+
+    def retire(self):
+        """Publish the parses of this version, once replaced by the next one.
+
+        Versions replaced before any analysis, like the intermediate ones of
+        fast typing, are not published.
+        """
+        if self._parses:
+            _metrics.set_gauge("parse.per_version", self.parses)
+
+    def _count(self, kind):
+        self._parses.add(kind)
+        _metrics.increment(f"parse.{kind}")
+
+
+class _DetachedTree:
+    """A tree of jedi, cached by parso under a path of its own.
+
+    Jedi finds the tree of a module in parso's cache by path while it infers.
+    The path is next to the document's, so that relative imports resolve the
+    same. The tree stays cached as long as a script, or a completion or name
+    inferred by one, holds its inference state.
+    """
+
+    def __init__(self, path):
+        path = Path(path).absolute()
+        name = f".{path.stem}-pylsp{next(_DETACHED_IDS)}{path.suffix}"
+        self.path = path.with_name(name)
+        self._lock = threading.Lock()
+        weakref.finalize(self, drop_jedi_tree, self.path)
+
+    def script(self, code, **kwargs):
+        # The first script parses the tree, the others find it up to date
+        with self._lock:
+            script = jedi.Script(code=code, path=self.path, **kwargs)
+        script._inference_state.pylsp_detached_tree = self
+        return script
+
+
+def jedi_path_lock(path):
+    """Return the lock to hold while jedi uses the tree of the module at `path`."""
+    return _JEDI_PATH_LOCKS[hash(Path(path)) % len(_JEDI_PATH_LOCKS)]
+
+
+def put_jedi_trees(path, trees):
+    """Cache `trees`, by grammar, as jedi's trees of the module at `path`.
+
+    The trees cached before, e.g. by jedi importing the module, are dropped.
+    """
+    take_jedi_trees(path)
+    for hashed, item in trees.items():
+        parso_cache.parser_cache.setdefault(hashed, {})[Path(path)] = item
+
+
+def take_jedi_trees(path):
+    """Remove jedi's trees of the module at `path` from the cache, by grammar."""
+    trees = {}
+    for hashed, grammar_cache in list(parso_cache.parser_cache.items()):
+        item = grammar_cache.pop(Path(path), None)
+        if item is not None:
+            trees[hashed] = item
+    return trees
+
+
+def jedi_trees_estimate(trees):
+    """Estimate the bytes of jedi's `trees`, by grammar."""
+    return sum(
+        sum(map(len, item.lines)) * PARSO_BYTES_PER_CHAR for item in trees.values()
+    )
+
+
+def jedi_tree_estimate(path):
+    """Estimate the bytes of the tree jedi keeps for the module at `path`."""
+    trees = {}
+    for hashed, grammar_cache in list(parso_cache.parser_cache.items()):
+        item = grammar_cache.get(Path(path))
+        if item is not None:
+            trees[hashed] = item
+    return jedi_trees_estimate(trees)
+
+
+def drop_jedi_tree(path):
+    """Drop the tree jedi keeps for the module at `path`, parsed again if needed."""
+    for grammar_cache in list(parso_cache.parser_cache.values()):
+        grammar_cache.pop(Path(path), None)
@@ -0,0 +1,337 @@
+# Copyright 2021- Python Language Server Contributors.
+
+"""Patch API support, generated from the ``apiData`` and sprite state settings.
+
+Patch programs call the API functions without importing them. To let jedi
+resolve them natively, the functions are written to a stub module that is put
+on jedi's ``sys_path``, and the code given to jedi ends with a star import of
+that module. The suffix only adds lines after the document, so positions in
+the document are unchanged.
+
+For hover and signature help on these names, jedi is not needed at all: an
+index of the API and state names answers them directly.
+
+Stubs and indexes are shared between the sessions of the server that use the
+same settings. Each config holds the ones built from its current settings
+until they change or `release` is called; `park` hands them over to a session
+snapshot instead.
+"""
+
+import hashlib
+import keyword
+import logging
+import os
+import re
+import tempfile
+import threading
+import weakref
+
+from pylsp._shared import SHARED, content_key
+
+log = logging.getLogger(__name__)
+
+STUB_MODULE = "_patch_api"
+
+DEFAULT_STUB_DIR = os.path.join(os.path.expanduser("~"), ".cache", "pylsp", "patch_api")
+
+RE_NON_WORD = re.compile(r"\W")
+RE_END_NAME = re.compile(r"([A-Za-z_][A-Za-z_0-9]*)\s*$")
+
+# Settings holding the sprite state names, and how to describe each of them
+STATE_KINDS = {
+    "targets": "Sprite",
+    "backdrops": "Backdrop",
+    "costumes": "Costume",
+    "sounds": "Sound",
+    "messages": "Message",
+}
+
+# Number of lines above the cursor searched for the call being typed
+CALL_CONTEXT_LINES = 20
+
+# Artifacts held by each config, by kind: the settings they were last checked
+# against, their shared key, the artifact itself and the data it was built
+# from. Config.settings() is cached, so the same settings object is returned
+# until the config changes.
+_HELD = weakref.WeakKeyDictionary()
+_HELD_LOCK = threading.Lock()
+
+
+def stub_path(config, stub_dir=DEFAULT_STUB_DIR):
+    """Return the sys_path entry holding the stub module of the Patch API.
+
+    Stubs are stored under a hash of their content, so they are only written
+    once per distinct API, even across sessions.
+    """
+    return _held_artifact(
+        config,
+        "stub",
+        lambda settings: settings.get("apiData"),
+        lambda api_data: _write_stub(api_data, stub_dir) if api_data else None,
+    )
+
+
+def _write_stub(api_data, stub_dir):
+    source = generate_stub(api_data)
+    digest = hashlib.sha1(source.encode("utf-8")).hexdigest()[:16]
+    path = os.path.join(stub_dir, digest)
+    stub_file = os.path.join(path, STUB_MODULE + ".pyi")
+    if not os.path.exists(stub_file):
+        try:
+            os.makedirs(path, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=path, suffix=".pyi")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(source)
+            os.replace(tmp_path, stub_file)
+        except OSError as e:
+            log.warning(f"Could not write the Patch API stub to {stub_file}: {e}")
+            return None
+    return path
+
+
+def _held_artifact(config, kind, data_from_settings, build):
+    return _held_entry(config, kind, data_from_settings, build)[1]
+
+
+def _held_entry(config, kind, data_from_settings, build):
+    """Return the shared key and the artifact of `kind` held for `config`."""
+    settings = config.settings()
+    with _HELD_LOCK:
+        held = _HELD.get(config)
+        if held is None:
+            held = _HELD[config] = {}
+            # Sessions that are never released still release on collection
+            weakref.finalize(config, _release_held, held)
+        entry = held.get(kind)
+    if entry is not None and entry[0] is settings:
+        return entry[1], entry[2]
+
+    data = data_from_settings(settings)
+    if entry is not None and entry[3] == data:
+        # Other settings changed, e.g. the sprite state for the stub
+        with _HELD_LOCK:
+            held[kind] = (settings,) + entry[1:]
+        return entry[1], entry[2]
+    key = content_key(kind, data)
+    artifact = SHARED.acquire(key, lambda: build(data))
+    with _HELD_LOCK:
+        held[kind] = (settings, key, artifact, data)
+    if entry is not None:
+        SHARED.release(entry[1])
+    return key, artifact
+
+
+def hold(config):
+    """Acquire the artifacts of `config` ahead of their first use.
+
+    A resumed session holds them before it releases those parked for it, so
+    that they are not rebuilt.
+    """
+    stub_path(config)
+    api_index(config)
+
+
+def release(config):
+    """Release the artifacts held for `config`, e.g. when its session ends."""
+    with _HELD_LOCK:
+        held = _HELD.pop(config, None)
+    if held:
+        _release_held(held)
+
+
+def park(config):
+    """Detach the artifacts held for `config` without releasing them.
+
+    Returns their keys, to pass to `release_keys` once they are not needed.
+    """
+    with _HELD_LOCK:
+        held = _HELD.pop(config, None) or {}
+        keys = [key for _settings, key, _artifact, _data in held.values()]
+        # Emptied, so that collecting the config does not release them too
+        held.clear()
+    return keys
+
+
+def release_keys(keys):
+    for key in keys:
+        SHARED.release(key)
+
+
+def _release_held(held):
+    while held:
+        _kind, (_settings, key, _artifact, _data) = held.popitem()
+        SHARED.release(key)
+
+
+def import_suffix(source):
+    """Return the code to append to `source` so that jedi sees the stub.
+
+    Unbalanced brackets, e.g. while typing the arguments of a call, are
+    closed first so that the import is parsed as its own statement.
+    """
+    depth = sum(source.count(c) for c in "([{") - sum(source.count(c) for c in ")]}")
+    return "\n" + ")" * max(depth, 0) + f"\nfrom {STUB_MODULE} import *\n"
+
+
+def generate_stub(api_data):
+    """Generate the source of the stub module for the given `apiData`."""
+    lines = ['"""Patch API functions."""', ""]
+    for func_name, details in api_data.items():
+        if not _is_name(func_name):
+            continue
+        details = details or {}
+        params = _param_names(details.get("parameters") or [])
+        lines.append(f"def {func_name}({', '.join(params)}):")
+        description = details.get("description")
+        if description:
+            lines.append(f"    {_docstring(description)}")
+        lines.append("    ...")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def _is_name(name):
+    return isinstance(name, str) and name.isidentifier() and not keyword.iskeyword(name)
+
+
+def _param_names(parameters):
+    names = []
+    for param in parameters:
+        name = RE_NON_WORD.sub("_", str(param).split("=", 1)[0].strip())
+        if not name or name[0].isdigit() or keyword.iskeyword(name):
+            name = "_" + name
+        while name in names:
+            name += "_"
+        names.append(name)
+    return names
+
+
+def _docstring(description):
+    text = str(description).replace("\\", "\\\\").replace('"""', '\\"\\"\\"')
+    return f'"""{text}"""'
+
+
+def api_index(config):
+    """Return a mapping of Patch API and sprite state names to their entries.
+
+    Function entries hold their parameters, description and signature label,
+    state entries the kind of state they name. The index is rebuilt only
+    when the settings change, and shared by configs with the same settings.
+    """
+    return _held_artifact(config, "index", _index_data, _build_index)
+
+
+def api_index_key(config):
+    """Return a key of the content of `api_index(config)`.
+
+    Results depending on the names of the index, like diagnostics, can be
+    cached under it: it only changes with them.
+    """
+    return _held_entry(config, "index", _index_data, _build_index)[0]
+
+
+def _index_data(settings):
+    data = {kind_key: settings.get(kind_key) for kind_key in STATE_KINDS}
+    data["apiData"] = settings.get("apiData")
+    return data
+
+
+def _build_index(data):
+    index = {}
+    for kind_key, kind in STATE_KINDS.items():
+        for name in data.get(kind_key) or []:
+            if isinstance(name, str):
+                index[name] = {"type": "state", "name": name, "kind": kind}
+    for func_name, details in (data.get("apiData") or {}).items():
+        if not _is_name(func_name):
+            continue
+        details = details or {}
+        params = _param_names(details.get("parameters") or [])
+        index[func_name] = {
+            "type": "function",
+            "name": func_name,
+            "parameters": params,
+            "description": str(details.get("description") or ""),
+            "signature": f"{func_name}({', '.join(params)})",
+        }
+    return index
+
+
+def lookup(document, name, index):
+    """Return the index entry for `name`, unless the document redefines it."""
+    entry = index.get(name)
+    if entry is None or is_shadowed(document.source, name):
+        return None
+    return entry
+
+
+def is_shadowed(source, name):
+    """Cheaply check if `source` defines, assigns or imports `name` itself."""
+    name = re.escape(name)
+    pattern = (
+        rf"^\s*(?:async\s+)?(?:def|class)\s+{name}\b"
+        rf"|^\s*{name}\s*(?::[^=\n]*)?=(?!=)"
+        rf"|^\s*(?:from\s+\S+\s+)?import\b.*\b{name}\b"
+    )
+    return re.search(pattern, source, re.MULTILINE) is not None
+
+
+def is_attribute(document, position, word):
+    """Check if the word under the cursor is accessed as an attribute."""
+    line = document.lines[position["line"]]
+    start = line.rfind(word, 0, position["character"] + len(word))
+    return start > 0 and line[:start].rstrip().endswith(".")
+
+
+def call_at_position(document, position):
+    """Find the call whose arguments are being typed at `position`.
+
+    Only the lines just above the cursor are scanned. Returns the name of the
+    called function and the index of the active argument, or None if the
+    cursor is not inside the parentheses of a call to a plain name.
+    """
+    lines = document.lines
+    line = position["line"]
+    if line >= len(lines):
+        return None
+    first_line = max(0, line - CALL_CONTEXT_LINES)
+    text = "".join(lines[first_line:line]) + lines[line][: position["character"]]
+
+    # Stack of (offset of the open bracket, number of commas seen in it)
+    stack = []
+    quote = None
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if quote:
+            if char == "\\":
+                i += 1
+            elif char == "\n" and len(quote) == 1:
+                # Unterminated string literal
+                quote = None
+            elif text.startswith(quote, i):
+                i += len(quote) - 1
+                quote = None
+        elif char == "#":
+            newline = text.find("\n", i)
+            i = len(text) if newline == -1 else newline
+        elif char in "'\"":
+            quote = char * 3 if text.startswith(char * 3, i) else char
+            i += len(quote) - 1
+        elif char in "([{":
+            stack.append([i, 0])
+        elif char in ")]}":
+            if stack:
+                stack.pop()
+        elif char == "," and stack:
+            stack[-1][1] += 1
+        i += 1
+
+    if quote or not stack or text[stack[-1][0]] != "(":
+        return None
+    offset, commas = stack[-1]
+    before = text[:offset]
+    match = RE_END_NAME.search(before)
+    if not match or before[: match.start()].rstrip().endswith("."):
+        return None
+    return match.group(1), commas
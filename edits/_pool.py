@@ -0,0 +1,124 @@
+# Copyright 2021- Python Language Server Contributors.
+
+"""Optional pool of processes running CPU heavy analysis, like pyflakes.
+
+Pure Python analysis holds the GIL while it runs, and slows down the
+requests of every session of the process. Once `configure` starts a pool,
+`run` ships such work to one of its processes and waits for the result,
+leaving the interpreter to the other requests. Without a pool, or if its
+process died, the work runs in the calling thread.
+
+Each process runs the jobs of the same documents, e.g. by document uri, so
+that the caches it keeps for them stay warm. Processes are forked from a
+server that imported `PRELOAD_MODULES`, then run a first lint before taking
+jobs, so that the first real job does not pay for the imports.
+"""
+
+import logging
+import multiprocessing
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from pylsp import _cancel, _metrics
+
+log = logging.getLogger(__name__)
+
+# Modules imported once by the server forking the processes
+PRELOAD_MODULES = ["pylsp.plugins.pyflakes_lint"]
+
+_lock = threading.Lock()
+POOL = None
+
+
+class AnalysisPool:
+    def __init__(self, size):
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(PRELOAD_MODULES)
+        self._context = context
+        self._executors = [self._start() for _ in range(size)]
+        _metrics.set_gauge("pool.processes", size)
+
+    def _start(self):
+        executor = ProcessPoolExecutor(max_workers=1, mp_context=self._context)
+        # Starts the process now, and warms it up before its first job
+        executor.submit(_warm_up)
+        return executor
+
+    def submit(self, affinity, fn, *args):
+        """Run `fn(*args)` in the process of `affinity`, returning its future."""
+        index = zlib.crc32(affinity.encode("utf-8")) % len(self._executors)
+        executor = self._executors[index]
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            executor = self.restart(index, executor)
+            future = executor.submit(fn, *args)
+        # To replace the process if it dies while running `fn`
+        future.restart = partial(self.restart, index, executor)
+        return future
+
+    def restart(self, index, executor):
+        """Replace the dead process `executor` at `index`, returning the new one."""
+        with _lock:
+            if self._executors[index] is not executor:
+                # Already replaced by another job
+                return self._executors[index]
+            self._executors[index] = replacement = self._start()
+        executor.shutdown(wait=False, cancel_futures=True)
+        _metrics.increment("pool.restarts")
+        log.warning("Restarted analysis process %d", index)
+        return replacement
+
+    def shutdown(self):
+        for executor in self._executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def configure(size):
+    """Start a pool of `size` processes, or run the analysis in process if 0."""
+    global POOL  # pylint: disable=global-statement
+    with _lock:
+        previous, POOL = POOL, AnalysisPool(size) if size else None
+    if previous is not None:
+        previous.shutdown()
+    if size:
+        log.info("Running analysis in %d processes", size)
+
+
+def shutdown():
+    configure(0)
+
+
+def run(affinity, fn, *args):
+    """Return `fn(*args)`, computed in the pool if there is one.
+
+    `fn` and its arguments must be picklable. Waiting stops once the current
+    work is cancelled, and `fn` is dropped if it has not started yet.
+    """
+    pool = POOL
+    if pool is None:
+        return fn(*args)
+
+    future = pool.submit(affinity, fn, *args)
+    _metrics.increment("pool.jobs")
+    try:
+        return _cancel.result(future)
+    except _cancel.RequestCancelled:
+        future.cancel()
+        raise
+    except BrokenProcessPool:
+        log.warning("Analysis process died, running %s in process", fn.__name__)
+        future.restart()
+        _metrics.increment("pool.fallbacks")
+        return fn(*args)
+
+
+def _warm_up():
+    # pylint: disable=import-outside-toplevel
+    from pylsp import _warmup
+    from pylsp.plugins import pyflakes_lint
+
+    pyflakes_lint.lint_source(_warmup.DUMMY_SOURCE, "warm_up.py", [])
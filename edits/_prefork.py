@@ -0,0 +1,186 @@
+# Copyright 2021- Python Language Server Contributors.
+
+"""Pre-forked worker processes sharing one listening socket.
+
+The supervisor binds the socket, then forks the workers, which all accept
+connections from it. A websocket session lives on one connection, so it stays
+on the worker that accepted it until it ends. The supervisor restarts workers
+that exit, and replaces workers whose memory grows past a limit: the
+replacement is started first, then the old worker stops accepting connections
+and exits once its sessions have ended.
+"""
+
+import logging
+import os
+import signal
+import socket
+import time
+
+log = logging.getLogger(__name__)
+
+# Seconds between two checks of the workers
+SUPERVISE_INTERVAL_S = 1
+# Seconds a retired worker is given to finish its sessions before it is killed
+DRAIN_TIMEOUT_S = 600
+# Workers exiting sooner than this after their start are restarted with a
+# delay, and are not checked for their memory before
+MIN_WORKER_LIFETIME_S = 5
+RESTART_DELAY_S = 1
+
+
+def worker_count(workers):
+    """Return the number of workers to fork, 0 meaning one per core."""
+    if workers > 0:
+        return workers
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def bind_socket(host, port):
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(socket.SOMAXCONN)
+    sock.set_inheritable(True)
+    return sock
+
+
+def rss_bytes(pid):
+    """Return the resident memory of process `pid`, or None if unknown."""
+    try:
+        with open(f"/proc/{pid}/statm", encoding="ascii") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Supervisor:
+    """Fork `workers` processes running `run_worker(sock)` and keep them alive.
+
+    `run_worker` must return once the worker receives SIGTERM and its sessions
+    have ended. `max_worker_memory` is in bytes; None disables the check.
+    """
+
+    def __init__(self, sock, workers, run_worker, max_worker_memory=None):
+        self._sock = sock
+        self._workers = workers
+        self._run_worker = run_worker
+        self._max_worker_memory = max_worker_memory
+        # pid -> start time of the workers accepting connections
+        self._active = {}
+        # pid -> time of retirement of the workers draining their sessions
+        self._retired = {}
+        self._stopping = False
+
+    def serve_forever(self):
+        rss = rss_bytes(os.getpid())
+        if self._max_worker_memory is not None and rss is not None:
+            if rss > self._max_worker_memory:
+                log.warning(
+                    "Workers start with %d MB, above their memory limit",
+                    rss // (1024 * 1024),
+                )
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for _ in range(self._workers):
+            self._spawn()
+
+        while not self._stopping:
+            time.sleep(SUPERVISE_INTERVAL_S)
+            self._reap()
+            self._check_memory()
+            self._kill_stale()
+            while not self._stopping and len(self._active) < self._workers:
+                self._spawn()
+
+        log.info("Stopping %d workers", len(self._active) + len(self._retired))
+        for pid in list(self._active) + list(self._retired):
+            self._signal(pid, signal.SIGTERM)
+        while self._active or self._retired:
+            try:
+                pid, _status = os.wait()
+            except ChildProcessError:
+                break
+            self._active.pop(pid, None)
+            self._retired.pop(pid, None)
+
+    def _stop(self, *_args):
+        self._stopping = True
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                self._run_worker(self._sock)
+            except BaseException:  # pylint: disable=broad-except
+                log.exception("Worker %d failed", os.getpid())
+                code = 1
+            finally:
+                logging.shutdown()
+                os._exit(code)  # pylint: disable=protected-access
+
+        log.info("Started worker %d", pid)
+        self._active[pid] = time.monotonic()
+        return pid
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+
+            if pid in self._retired:
+                del self._retired[pid]
+                log.info("Retired worker %d exited", pid)
+                continue
+
+            started = self._active.pop(pid, None)
+            if started is None or self._stopping:
+                continue
+            log.warning(
+                "Worker %d exited with status %d, restarting it",
+                pid,
+                os.waitstatus_to_exitcode(status),
+            )
+            if time.monotonic() - started < MIN_WORKER_LIFETIME_S:
+                # Do not spin when workers fail right away
+                time.sleep(RESTART_DELAY_S)
+
+    def _check_memory(self):
+        if self._max_worker_memory is None:
+            return
+        now = time.monotonic()
+        for pid, started in list(self._active.items()):
+            if now - started < MIN_WORKER_LIFETIME_S:
+                continue
+            rss = rss_bytes(pid)
+            if rss is None or rss <= self._max_worker_memory:
+                continue
+            log.warning(
+                "Worker %d uses %d MB, replacing it", pid, rss // (1024 * 1024)
+            )
+            self._spawn()
+            del self._active[pid]
+            self._retired[pid] = time.monotonic()
+            self._signal(pid, signal.SIGTERM)
+
+    def _kill_stale(self):
+        now = time.monotonic()
+        for pid, retired in list(self._retired.items()):
+            if now - retired > DRAIN_TIMEOUT_S:
+                log.warning("Retired worker %d did not exit, killing it", pid)
+                self._signal(pid, signal.SIGKILL)
+
+    @staticmethod
+    def _signal(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
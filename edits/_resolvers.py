@@ -0,0 +1,398 @@
+# Copyright 2017-2020 Palantir Technologies, Inc.
+# Copyright 2021- Python Language Server Contributors.
+
+import atexit
+import functools
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import defaultdict
+from importlib import metadata, util
+from time import time
+
+import jedi
+from jedi.api.classes import Completion
+
+from pylsp import lsp
+
+log = logging.getLogger(__name__)
+
+# Bump when the layout of the persisted entries changes
+CACHE_FORMAT_VERSION = 1
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "pylsp", "resolvers"
+)
+
+# Modules whose resolutions are cached, in memory and on disk: the large
+# libraries jedi is slow on, see
+# https://github.com/davidhalter/jedi/blob/master/jedi/inference/helpers.py#L194-L202
+# and the standard modules Patch programs use most
+DEFAULT_CACHED_MODULES = frozenset(
+    (
+        "pandas",
+        "numpy",
+        "tensorflow",
+        "matplotlib",
+        "math",
+        "random",
+        "time",
+        "string",
+        "datetime",
+        "collections",
+        "itertools",
+        "json",
+        "re",
+    )
+)
+
+# Seconds new resolutions wait before they are written to disk, all at once
+PERSIST_DELAY_S = 5.0
+
+_MISSING = object()
+
+# The resolver settings applied to the process, see `configure`
+_configured = {"settings": None}
+_configure_lock = threading.Lock()
+
+
+# ---- Base class
+# -----------------------------------------------------------------------------
+class Resolver:
+    def __init__(self, callback, resolve_on_error, time_to_live=60 * 30, name=None):
+        self.callback = callback
+        self.name = name
+        self.resolve_on_error = resolve_on_error
+        self._cache = {}
+        self._time_to_live = time_to_live
+        self._cache_ttl = defaultdict(set)
+        self._clear_every = 2
+        self._cached_modules = set(DEFAULT_CACHED_MODULES)
+        # Resolutions of the cached modules are also persisted on disk, one
+        # file per module name, module version and environment
+        self._cache_dir = DEFAULT_CACHE_DIR
+        self._persisted = {}
+        self._dirty = set()
+        # Guards the caches, shared by the completions running side by side
+        self._lock = threading.RLock()
+        # Writes the persisted files, one at a time
+        self._persist_lock = threading.Lock()
+        self._persist_timer = None
+
+    @property
+    def cached_modules(self):
+        return self._cached_modules
+
+    @cached_modules.setter
+    def cached_modules(self, new_value):
+        self._cached_modules = set(new_value)
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    @cache_dir.setter
+    def cache_dir(self, new_value):
+        if new_value != self._cache_dir:
+            self.persist()
+            with self._lock:
+                self._persisted = {}
+                self._cache_dir = new_value
+
+    def clear_outdated(self):
+        now = self.time_key()
+        with self._lock:
+            to_clear = [timestamp for timestamp in self._cache_ttl if timestamp < now]
+            for time_key in to_clear:
+                for key in self._cache_ttl[time_key]:
+                    self._cache.pop(key, None)
+                del self._cache_ttl[time_key]
+
+    def time_key(self):
+        return int(time() / self._time_to_live)
+
+    def get_or_create(self, completion: Completion):
+        if not completion.full_name:
+            use_cache = False
+        else:
+            module_parts = completion.full_name.split(".")
+            use_cache = module_parts and module_parts[0] in self._cached_modules
+
+        if use_cache:
+            key = self._create_completion_id(completion)
+            value = self._cache.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+            if self.time_key() % self._clear_every == 0:
+                self.clear_outdated()
+
+            value = self._load_persisted(completion)
+            if value is _MISSING:
+                # Resolved without the lock, it takes jedi a while
+                value = self.resolve(completion)
+                self._store_persisted(completion, value)
+            with self._lock:
+                self._cache[key] = value
+                self._cache_ttl[self.time_key()].add(key)
+            return value
+
+        return self.resolve(completion)
+
+    def _create_completion_id(self, completion: Completion):
+        return (
+            completion.full_name,
+            completion.module_path,
+            completion.line,
+            completion.column,
+            self.time_key(),
+        )
+
+    def _store_key(self, completion: Completion):
+        """Return the key of the file of `completion`, None not to persist it."""
+        module_name = completion.full_name.split(".")[0]
+        module_version = _module_version(module_name)
+        if module_version is None:
+            return None
+        return (module_name, module_version, _environment_id(completion))
+
+    def _entries(self, store_key):
+        with self._lock:
+            entries = self._persisted.get(store_key)
+            if entries is None:
+                entries = {}
+                try:
+                    with open(self._store_path(store_key), "r", encoding="utf-8") as f:
+                        data = json.load(f)
+                    if data.get("format") == CACHE_FORMAT_VERSION:
+                        entries = data.get("entries", {})
+                except (OSError, ValueError):
+                    pass
+                self._persisted[store_key] = entries
+            return entries
+
+    def _store_path(self, store_key):
+        module_name, module_version, environment_id = store_key
+        return os.path.join(
+            self._cache_dir,
+            f"v{CACHE_FORMAT_VERSION}",
+            self.name,
+            f"{module_name}-{module_version}-{environment_id}.json",
+        )
+
+    @staticmethod
+    def _entry_key(completion: Completion):
+        return f"{completion.full_name}:{completion.line}:{completion.column}"
+
+    def _load_persisted(self, completion: Completion):
+        store_key = None if self.name is None else self._store_key(completion)
+        if store_key is None:
+            return _MISSING
+        entries = self._entries(store_key)
+        return entries.get(self._entry_key(completion), _MISSING)
+
+    def _store_persisted(self, completion: Completion, value):
+        # Failed resolutions are retried in the next session instead
+        if self.name is None or value == self.resolve_on_error:
+            return
+        store_key = self._store_key(completion)
+        if store_key is None:
+            return
+        with self._lock:
+            self._entries(store_key)[self._entry_key(completion)] = value
+            self._dirty.add(store_key)
+            timer = self._persist_timer
+            # Not alive either when inherited by a forked process
+            if timer is None or not timer.is_alive():
+                timer = self._persist_timer = threading.Timer(
+                    PERSIST_DELAY_S, self.persist
+                )
+                timer.daemon = True
+                timer.start()
+
+    def persist(self):
+        """Write the resolutions added since the last call to disk."""
+        with self._persist_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+                files = [
+                    (self._store_path(key), dict(self._persisted.get(key, {})))
+                    for key in dirty
+                ]
+            for path, entries in files:
+                self._write(path, entries)
+
+    @staticmethod
+    def _write(path, entries):
+        data = {"format": CACHE_FORMAT_VERSION, "entries": entries}
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            # e.g. a read-only cache baked into the image
+            log.debug(f"Could not persist resolver cache to {path}: {e}")
+
+    def resolve(self, completion):
+        try:
+            sig = completion.get_signatures()
+            return self.callback(completion, sig)
+        except Exception as e:
+            log.warning(
+                f"Something went wrong when resolving label for {completion}: {e}"
+            )
+            return self.resolve_on_error
+
+
+# ---- Label resolver
+# -----------------------------------------------------------------------------
+def format_label(completion, sig):
+    if sig and completion.type in ("function", "method"):
+        params = ", ".join(param.name for param in sig[0].params)
+        label = "{}({})".format(completion.name, params)
+        return label
+    return completion.name
+
+
+LABEL_RESOLVER = Resolver(callback=format_label, resolve_on_error="", name="label")
+
+
+# ---- Snippets resolver
+# -----------------------------------------------------------------------------
+def format_snippet(completion, sig):
+    if not sig:
+        return {}
+
+    snippet_completion = {}
+
+    positional_args = [
+        param
+        for param in sig[0].params
+        if "=" not in param.description and param.name not in {"/", "*"}
+    ]
+
+    if len(positional_args) > 1:
+        # For completions with params, we can generate a snippet instead
+        snippet_completion["insertTextFormat"] = lsp.InsertTextFormat.Snippet
+        snippet = completion.name + "("
+        for i, param in enumerate(positional_args):
+            snippet += "${%s:%s}" % (i + 1, param.name)
+            if i < len(positional_args) - 1:
+                snippet += ", "
+        snippet += ")$0"
+        snippet_completion["insertText"] = snippet
+    elif len(positional_args) == 1:
+        snippet_completion["insertTextFormat"] = lsp.InsertTextFormat.Snippet
+        snippet_completion["insertText"] = completion.name + "($0)"
+    else:
+        snippet_completion["insertText"] = completion.name + "()"
+
+    return snippet_completion
+
+
+SNIPPET_RESOLVER = Resolver(
+    callback=format_snippet, resolve_on_error={}, name="snippet"
+)
+
+
+# ---- Persisted cache keys
+# -----------------------------------------------------------------------------
+@functools.lru_cache(maxsize=None)
+def _module_version(module_name):
+    """Return what identifies the installed version of a module.
+
+    This is the version of its distribution, or else the modification time
+    and size of its file. Modules built into the interpreter share its
+    version, which is part of the environment id. None for modules that
+    cannot be found, whose resolutions are then not persisted.
+    """
+    try:
+        return metadata.version(module_name)
+    except (metadata.PackageNotFoundError, ValueError):
+        pass
+    try:
+        spec = util.find_spec(module_name)
+    except (ImportError, ValueError):
+        spec = None
+    if spec is None or spec.origin is None:
+        return None
+    if spec.origin in ("built-in", "frozen"):
+        return spec.origin
+    try:
+        stat = os.stat(spec.origin)
+    except OSError:
+        return None
+    return f"{stat.st_mtime_ns:x}.{stat.st_size:x}"
+
+
+def _environment_id(completion):
+    try:
+        environment = completion._inference_state.environment
+        identity = f"{environment.executable}:{environment.version_info}"
+    except AttributeError:
+        identity = "default"
+    return hashlib.sha1(identity.encode()).hexdigest()[:12]
+
+
+def configure(settings):
+    """Apply the `cache_for` and `resolver_cache_dir` completion settings.
+
+    The resolvers are shared by every session of the process, so only the
+    settings of the first call apply, i.e. those of the server at startup.
+    """
+    with _configure_lock:
+        if _configured["settings"] is not None:
+            if settings != _configured["settings"]:
+                log.debug("Resolver settings are only applied at startup")
+            return
+        _configured["settings"] = settings
+    for resolver in (LABEL_RESOLVER, SNIPPET_RESOLVER):
+        if settings.get("cache_for") is not None:
+            resolver.cached_modules = settings["cache_for"]
+        if settings.get("resolver_cache_dir") is not None:
+            resolver.cache_dir = settings["resolver_cache_dir"]
+
+
+def persist_all():
+    """Write the new resolutions of both resolvers to disk, e.g. on exit."""
+    LABEL_RESOLVER.persist()
+    SNIPPET_RESOLVER.persist()
+
+
+atexit.register(persist_all)
+
+
+def prebuild(modules=None):
+    """Populate the on-disk label and snippet caches for the given modules.
+
+    This is meant to run at image build time, so that the first completions
+    of a fresh session are served from disk. By default, the cached modules
+    installed in the image are prebuilt.
+    """
+    if modules is None:
+        modules = [
+            module_name
+            for module_name in LABEL_RESOLVER.cached_modules
+            if util.find_spec(module_name) is not None
+        ]
+    modules = set(modules)
+    for resolver in (LABEL_RESOLVER, SNIPPET_RESOLVER):
+        resolver.cached_modules = resolver.cached_modules | modules
+
+    for module_name in sorted(modules):
+        script = jedi.Script(f"import {module_name}\n{module_name}.")
+        try:
+            completions = script.complete(2, len(module_name) + 1)
+        except Exception as e:
+            log.warning(f"Could not prebuild resolver cache for {module_name}: {e}")
+            continue
+        for completion in completions:
+            LABEL_RESOLVER.get_or_create(completion)
+            SNIPPET_RESOLVER.get_or_create(completion)
+        log.info(f"Prebuilt resolver cache for {module_name}")
+
+    persist_all()
@@ -0,0 +1,180 @@
+# Copyright 2021- Python Language Server Contributors.
+
+"""Process wide scheduling of requests and lints by priority class.
+
+Work is queued in one of `PRIORITIES`, from the most to the least urgent:
+``interactive`` requests the user waits for while typing, ``diagnostics``
+and ``workspace`` wide work. Idle workers take the oldest job of the most
+urgent class that is below its concurrency limit, so a burst of lints never
+takes all the workers from completions. A job waiting for longer than the
+maximum wait of its class is taken first, so that less urgent classes are
+not starved.
+
+Under the GIL, a job only runs fast if other jobs leave it the interpreter.
+Less urgent jobs call `yield_to_urgent` between their steps, through
+`pylsp._cancel.check`, which pauses them once while more urgent jobs run.
+The interactive class never takes every worker, so that the other classes
+always have one to run on.
+
+Each class records the gauges ``scheduler.<class>.queued``, ``.running`` and
+``.wait_ms``, a smoothed time spent queued, and counts the jobs taken because
+of their wait in ``scheduler.<class>.aged``.
+"""
+
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from pylsp import _metrics
+
+log = logging.getLogger(__name__)
+
+PRIORITIES = ("interactive", "diagnostics", "workspace")
+
+DEFAULT_WORKERS = 8
+# Jobs of a class running at the same time, at most. Pure Python work gains
+# nothing from running side by side under the GIL, and CPython 3.11 can fail
+# to compile in several threads at once, as pyflakes does. Interactive jobs
+# leave a worker to each of the other classes.
+DEFAULT_LIMITS = {
+    "interactive": DEFAULT_WORKERS - 2,
+    "diagnostics": 1,
+    "workspace": 1,
+}
+# Seconds a job of a class may wait before it is taken ahead of its turn
+DEFAULT_MAX_WAIT_S = {"diagnostics": 2.0, "workspace": 5.0}
+# Seconds a job pauses at most in `yield_to_urgent`, which it does once
+MAX_YIELD_S = 0.5
+
+# Weight of the last wait in the smoothed wait time
+WAIT_SMOOTHING = 0.2
+
+
+class Scheduler:
+    def __init__(self, workers=DEFAULT_WORKERS, limits=None, max_wait=None):
+        self._workers = workers
+        self._limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self._max_wait = dict(DEFAULT_MAX_WAIT_S, **(max_wait or {}))
+        self._cond = threading.Condition()
+        self._queues = {priority: collections.deque() for priority in PRIORITIES}
+        self._running = dict.fromkeys(PRIORITIES, 0)
+        self._wait_ms = dict.fromkeys(PRIORITIES, 0.0)
+        # Started on the first job, so that the scheduler survives forking
+        self._threads = []
+        # Class of the job run by the current worker, and whether it yielded
+        self._local = threading.local()
+
+    def submit(self, priority, fn, *args, **kwargs):
+        """Queue `fn(*args, **kwargs)` in class `priority`, returning its future."""
+        if priority not in self._queues:
+            raise ValueError(f"Unknown priority class {priority!r}")
+        future = Future()
+        with self._cond:
+            self._start_workers()
+            self._queues[priority].append((time.monotonic(), future, fn, args, kwargs))
+            self._publish(priority)
+            self._cond.notify()
+        return future
+
+    def yield_to_urgent(self):
+        """Pause the current job while jobs of a more urgent class run or wait.
+
+        A job pauses once at most, so that a steady flow of urgent requests
+        holds it up by `MAX_YIELD_S` and no more.
+        """
+        priority = getattr(self._local, "priority", None)
+        if priority is None or self._local.yielded:
+            return
+        urgent = PRIORITIES[: PRIORITIES.index(priority)]
+        deadline = time.monotonic() + MAX_YIELD_S
+        with self._cond:
+            if not self._urgent_pending(urgent):
+                return
+            self._local.yielded = True
+            _metrics.increment(f"scheduler.{priority}.yields")
+            while self._urgent_pending(urgent):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+    def _urgent_pending(self, urgent):
+        return any(self._running[p] or self._queues[p] for p in urgent)
+
+    def _start_workers(self):
+        while len(self._threads) < self._workers:
+            thread = threading.Thread(
+                target=self._work,
+                name=f"pylsp_scheduler_{len(self._threads)}",
+                daemon=True,
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def _next(self, now):
+        """Return the class to take a job from, and whether it is overdue."""
+        available = [
+            priority
+            for priority in PRIORITIES
+            if self._queues[priority]
+            and self._running[priority] < self._limits[priority]
+        ]
+        overdue = []
+        for priority in available:
+            max_wait = self._max_wait.get(priority)
+            waited = now - self._queues[priority][0][0]
+            if max_wait is not None and waited > max_wait:
+                overdue.append((waited - max_wait, priority))
+        if overdue:
+            return max(overdue)[1], True
+        if available:
+            return available[0], False
+        return None, False
+
+    def _work(self):
+        while True:
+            with self._cond:
+                priority, overdue = self._next(time.monotonic())
+                while priority is None:
+                    self._cond.wait()
+                    priority, overdue = self._next(time.monotonic())
+                queued_at, future, fn, args, kwargs = self._queues[priority].popleft()
+                self._running[priority] += 1
+                wait_ms = (time.monotonic() - queued_at) * 1000
+                self._wait_ms[priority] = (
+                    WAIT_SMOOTHING * wait_ms
+                    + (1 - WAIT_SMOOTHING) * self._wait_ms[priority]
+                )
+                self._publish(priority)
+            if overdue:
+                _metrics.increment(f"scheduler.{priority}.aged")
+
+            self._local.priority = priority
+            self._local.yielded = False
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        result = fn(*args, **kwargs)
+                    except BaseException as e:  # pylint: disable=broad-except
+                        future.set_exception(e)
+                    else:
+                        future.set_result(result)
+            finally:
+                self._local.priority = None
+                with self._cond:
+                    self._running[priority] -= 1
+                    self._publish(priority)
+                    # Jobs held back by the limit of this class may run now
+                    self._cond.notify_all()
+
+    def _publish(self, priority):
+        _metrics.set_gauge(f"scheduler.{priority}.queued", len(self._queues[priority]))
+        _metrics.set_gauge(f"scheduler.{priority}.running", self._running[priority])
+        _metrics.set_gauge(
+            f"scheduler.{priority}.wait_ms", round(self._wait_ms[priority], 1)
+        )
+
+
+SCHEDULER = Scheduler()
@@ -0,0 +1,178 @@
+# Copyright 2021- Python Language Server Contributors.
+
+"""Snapshots of websocket sessions, to resume them after a reconnection.
+
+When a session ends without a shutdown, e.g. because the connection dropped,
+its open documents and last settings are saved under its session token. A
+client reconnecting with that token in the ``resumeToken`` initialization
+option gets them back, and does not need to open its documents or push its
+settings again.
+
+Snapshots are files, so that any worker process can resume them. Settings are
+stored once per distinct content, as sessions of a class mostly share them.
+The shared artifacts built from the settings are kept in the process that
+saved the snapshot until it is resumed or expires, so that a session resumed
+on the same worker finds them warm.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+from pylsp import _metrics, _patch_api
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SESSION_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "pylsp", "sessions"
+)
+# Seconds a snapshot can be resumed for
+DEFAULT_TTL_S = 600
+# Seconds between two removals of the expired snapshots
+PRUNE_INTERVAL_S = 60
+
+# Bump when the layout of the snapshots changes
+SNAPSHOT_VERSION = 1
+
+RE_TOKEN = re.compile(r"^[A-Za-z0-9_-]{16,64}$")
+
+
+class SessionStore:
+    def __init__(self, directory=DEFAULT_SESSION_DIR, ttl=DEFAULT_TTL_S):
+        self._directory = directory
+        self._settings_dir = os.path.join(directory, "settings")
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        # token -> (expiry, keys) of the shared artifacts kept warm
+        self._parked = {}
+        self._last_prune = 0
+
+    def save(self, token, root_uri, documents, settings, configs=()):
+        """Save a snapshot of a session under `token`.
+
+        `documents` are dicts with the uri, text and version of the open
+        documents. The artifacts held for `configs` are kept until the
+        snapshot is taken or expires.
+        """
+        self._prune()
+        snapshot = {
+            "version": SNAPSHOT_VERSION,
+            "root_uri": root_uri,
+            "documents": documents,
+            "settings": None if settings is None else self._save_settings(settings),
+        }
+        try:
+            self._write(self._snapshot_path(token), json.dumps(snapshot))
+        except OSError as e:
+            log.warning("Could not save the snapshot of session %s: %s", token, e)
+            return False
+
+        keys = []
+        for config in configs:
+            keys.extend(_patch_api.park(config))
+        with self._lock:
+            self._parked[token] = (time.monotonic() + self._ttl, keys)
+        _metrics.increment("sessions.snapshots_saved")
+        log.info("Saved the snapshot of session %s", token)
+        return True
+
+    def take(self, token):
+        """Return the snapshot saved under `token` and remove it, or None.
+
+        The snapshot contains the root uri, documents and settings of the
+        session. Expired and unknown snapshots are None.
+        """
+        self._prune()
+        if not isinstance(token, str) or not RE_TOKEN.match(token):
+            return None
+        path = self._snapshot_path(token)
+        try:
+            with open(path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+            expired = time.time() - os.path.getmtime(path) > self._ttl
+            os.remove(path)
+        except (OSError, ValueError) as e:
+            log.info("No snapshot to resume session %s: %s", token, e)
+            _metrics.increment("sessions.resume_missed")
+            return None
+        if expired or snapshot.get("version") != SNAPSHOT_VERSION:
+            _metrics.increment("sessions.resume_missed")
+            return None
+
+        settings_key = snapshot["settings"]
+        if settings_key is not None:
+            try:
+                with open(self._settings_path(settings_key), encoding="utf-8") as f:
+                    snapshot["settings"] = json.load(f)
+            except (OSError, ValueError) as e:
+                log.warning("Could not read the settings of session %s: %s", token, e)
+                _metrics.increment("sessions.resume_missed")
+                return None
+        _metrics.increment("sessions.resumed")
+        return snapshot
+
+    def release(self, token):
+        """Release the artifacts kept warm for the snapshot `token`."""
+        with self._lock:
+            _expiry, keys = self._parked.pop(token, (None, ()))
+        _patch_api.release_keys(keys)
+
+    def _save_settings(self, settings):
+        payload = json.dumps(settings, sort_keys=True)
+        key = hashlib.sha1(payload.encode("utf-8")).hexdigest()
+        path = self._settings_path(key)
+        if os.path.exists(path):
+            # Keeps it from expiring while snapshots use it
+            os.utime(path)
+        else:
+            self._write(path, payload)
+        return key
+
+    def _snapshot_path(self, token):
+        return os.path.join(self._directory, token + ".json")
+
+    def _settings_path(self, key):
+        return os.path.join(self._settings_dir, key + ".json")
+
+    @staticmethod
+    def _write(path, payload):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+
+    def _prune(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_prune < PRUNE_INTERVAL_S:
+                return
+            self._last_prune = now
+            expired = [
+                token for token, (expiry, _keys) in self._parked.items() if expiry < now
+            ]
+        for token in expired:
+            self.release(token)
+
+        deadline = time.time() - self._ttl
+        for directory in (self._directory, self._settings_dir):
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_file() and entry.stat().st_mtime < deadline:
+                        os.remove(entry.path)
+                except OSError:
+                    continue
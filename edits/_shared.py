@@ -0,0 +1,72 @@
+# Copyright 2021- Python Language Server Contributors.
+
+"""Read-only artifacts shared between the sessions of one server process.
+
+Heavy objects that do not depend on a session, like jedi environments or the
+Patch API index built from a given ``apiData``, are stored once under a key
+describing their content. Every session holding one acquires it and releases
+it when done; an artifact is dropped once no session holds it anymore.
+Artifacts must not be mutated by their holders.
+"""
+
+import hashlib
+import json
+import logging
+import threading
+
+from pylsp import _metrics
+
+log = logging.getLogger(__name__)
+
+
+class SharedArtifacts:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._artifacts = {}
+        self._refcounts = {}
+
+    def acquire(self, key, factory):
+        """Return the artifact stored under `key`, building it if needed.
+
+        Each call must be paired with a call to `release`.
+        """
+        with self._lock:
+            if key in self._artifacts:
+                self._refcounts[key] += 1
+                return self._artifacts[key]
+
+        # Built outside the lock, other artifacts stay available meanwhile
+        artifact = factory()
+        with self._lock:
+            if key in self._artifacts:
+                artifact = self._artifacts[key]
+                self._refcounts[key] += 1
+            else:
+                self._artifacts[key] = artifact
+                self._refcounts[key] = 1
+            _metrics.set_gauge("shared.artifacts", len(self._artifacts))
+        return artifact
+
+    def release(self, key):
+        with self._lock:
+            if key not in self._refcounts:
+                log.debug(f"Releasing unknown shared artifact {key}")
+                return
+            self._refcounts[key] -= 1
+            if self._refcounts[key] <= 0:
+                del self._refcounts[key]
+                del self._artifacts[key]
+            _metrics.set_gauge("shared.artifacts", len(self._artifacts))
+
+    def refcount(self, key):
+        with self._lock:
+            return self._refcounts.get(key, 0)
+
+
+SHARED = SharedArtifacts()
+
+
+def content_key(kind, data):
+    """Build a key for an artifact of the given kind from JSON-like data."""
+    payload = json.dumps(data, sort_keys=True, default=str)
+    return (kind, hashlib.sha1(payload.encode("utf-8")).hexdigest())
@@ -0,0 +1,98 @@
+# Copyright 2021- Python Language Server Contributors.
+
+"""Warm start of the server, before it accepts any session.
+
+Starting is split in phases, each logged with its duration and recorded as a
+``startup.<phase>_ms`` gauge. `preload` imports the heavy modules and the
+enabled plugins; it starts no thread or process, so it can run before forking
+workers. `warm_up` then resolves the default jedi environment, which starts
+its subprocess, and runs a completion and a lint pass on a dummy document,
+which loads typeshed and fills the parso and jedi caches. It must run in
+each process serving sessions.
+"""
+
+import contextlib
+import importlib
+import logging
+import os
+import tempfile
+import time
+
+from pylsp import _metrics, uris
+from pylsp.config import config, lazy_plugins
+from pylsp.plugins import _resolvers
+
+log = logging.getLogger(__name__)
+
+# Modules imported by the plugins on their first use
+PRELOAD_MODULES = (
+    "jedi",
+    "parso",
+    "pyflakes.api",
+    "pyflakes.checker",
+    "cattrs",
+    "lsprotocol.types",
+)
+
+DUMMY_SOURCE = """import os
+import sys
+
+
+def greet(name):
+    print(os.path.join(sys.prefix, name))
+
+
+greet(undefined)
+os.path.jo
+"""
+DUMMY_POSITION = {"line": 9, "character": 10}
+
+
+@contextlib.contextmanager
+def _phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        _metrics.set_gauge(f"startup.{name}_ms", round(elapsed_ms, 1))
+        log.info("Startup phase %s took %.0f ms", name, elapsed_ms)
+
+
+def preload():
+    """Import the modules used by the plugins, and the plugins themselves."""
+    with _phase("imports"):
+        for module in PRELOAD_MODULES:
+            try:
+                importlib.import_module(module)
+            except ImportError:
+                log.debug("Not preloading missing module %s", module)
+    with _phase("plugins"):
+        # Plugins are registered by the first config, and imported once enabled
+        default_config = config.Config(uris.from_fs_path(os.getcwd()), {}, 0, {})
+        lazy_plugins.load_enabled(default_config)
+    # Shared by the sessions of each worker, so set once from the server's own
+    # configuration
+    _resolvers.configure(default_config.plugin_settings("jedi_completion"))
+    log.info("Plugin import times in ms: %s", lazy_plugins.import_report())
+
+
+def warm_up(handler_class):
+    """Run a completion and a lint pass on a dummy document."""
+    with tempfile.TemporaryDirectory() as root:
+        server = handler_class(rx=None, tx=None, consumer=lambda _message: None)
+        with _phase("initialize"):
+            server.m_initialize(rootUri=uris.from_fs_path(root))
+        try:
+            doc_uri = uris.from_fs_path(os.path.join(root, "warm_up.py"))
+            server.workspace.put_document(doc_uri, DUMMY_SOURCE, version=1)
+            with _phase("environment"):
+                server.workspace.get_document(doc_uri).jedi_script()
+            with _phase("completion"):
+                server.completions(doc_uri, DUMMY_POSITION)
+            with _phase("lint"):
+                # Not through the debounced lint, to wait for the diagnostics
+                # pylint: disable-next=protected-access
+                server._hook("pylsp_lint", doc_uri, is_saved=True)
+        finally:
+            server.close()
@@ -0,0 +1,76 @@
+# Copyright 2017-2020 Palantir Technologies, Inc.
+# Copyright 2021- Python Language Server Contributors.
+
+import logging
+
+from pylsp import _patch_api, _utils, hookimpl
+
+log = logging.getLogger(__name__)
+
+
+@hookimpl
+def pylsp_hover(config, document, position):
+    word = document.word_at_position(position)
+
+    # Patch API and sprite state names are answered from their index
+    entry = None
+    if word and not _patch_api.is_attribute(document, position, word):
+        entry = _patch_api.lookup(
+            document, word, _patch_api.api_index(config)
+        )
+    if entry:
+        return _patch_api_hover(config, entry)
+
+    code_position = _utils.position_to_jedi_linecolumn(document, position)
+    definitions = document.jedi_script(use_document_path=True).infer(**code_position)
+
+    # Find first exact matching definition
+    definition = next((x for x in definitions if x.name == word), None)
+
+    # Ensure a definition is used if only one is available
+    # even if the word doesn't match. An example of this case is 'np'
+    # where 'numpy' doesn't match with 'np'. Same for NumPy ufuncs
+    if len(definitions) == 1:
+        definition = definitions[0]
+
+    if not definition:
+        return {"contents": ""}
+
+    preferred_markup_kind = _hover_markup_kind(config)
+
+    # Find first exact matching signature
+    signature = next(
+        (
+            x.to_string()
+            for x in definition.get_signatures()
+            if (x.name == word and x.type not in ["module"])
+        ),
+        "",
+    )
+
+    return {
+        "contents": _utils.format_docstring(
+            # raw docstring returns only doc, without signature
+            definition.docstring(raw=True),
+            preferred_markup_kind,
+            signatures=[signature] if signature else None,
+        )
+    }
+
+
+def _hover_markup_kind(config):
+    hover_capabilities = config.capabilities.get("textDocument", {}).get("hover", {})
+    supported_markup_kinds = hover_capabilities.get("contentFormat", ["markdown"])
+    return _utils.choose_markup_kind(supported_markup_kinds)
+
+
+def _patch_api_hover(config, entry):
+    if entry["type"] == "function":
+        contents, signatures = entry["description"], [entry["signature"]]
+    else:
+        contents, signatures = entry["kind"], [entry["name"]]
+    return {
+        "contents": _utils.format_docstring(
+            contents, _hover_markup_kind(config), signatures=signatures
+        )
+    }
@@ -1,12 +1,22 @@
 # Copyright 2017-2020 Palantir Technologies, Inc.
 # Copyright 2021- Python Language Server Contributors.
 
+import builtins
+import keyword
 import logging
 import os
-
-import parso
-
-from pylsp import _utils, hookimpl, lsp
+import re
+import subprocess
+import sys
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+
+from pylsp import _cancel, _metrics, _patch_api, _scheduler, _utils, hookimpl, lsp
+from pylsp.plugins import _resolvers
 from pylsp.plugins._resolvers import LABEL_RESOLVER, SNIPPET_RESOLVER
 
 log = logging.getLogger(__name__)
@@ -34,6 +44,42 @@ _IMPORTS = ("import_name", "import_from")
 # Types of parso node for errors
 _ERRORS = ("error_node",)
 
+# Settings the completions of a document depend on, besides its source
+COMPLETION_SETTINGS = frozenset(
+    ("apiData", "plugins.jedi", "plugins.jedi_completion", *_patch_api.STATE_KINDS)
+)
+
+# Names of the exception classes of each configured jedi environment, built
+# on first use. See `is_exception_class`.
+_EXCEPTION_CLASS_NAMES = {}
+
+# Prints the names of the builtin exceptions of the interpreter of a jedi
+# environment
+_EXCEPTION_NAMES_SCRIPT = (
+    "import builtins; print(' '.join(name for name, value in vars(builtins).items()"
+    " if isinstance(value, type) and issubclass(value, BaseException)))"
+)
+
+# Seconds to wait for the interpreter of a jedi environment to list them
+_EXCEPTION_NAMES_TIMEOUT_S = 10
+
+# Background jedi completions of each workspace run on its own worker, so
+# that inference can carry on once a request's deadline has passed without
+# holding up other sessions. See `_completion_worker`.
+_COMPLETION_WORKERS = weakref.WeakKeyDictionary()
+_COMPLETION_WORKERS_LOCK = threading.Lock()
+
+# Cancellation token of each speculative completion, by its future
+_SPECULATION_TOKENS = weakref.WeakKeyDictionary()
+
+# Measured cost of resolving the label and snippet of one completion item,
+# smoothed over requests. See `_resolve_count`.
+_RESOLVE_COST = {"per_item": None}
+RESOLVE_COST_SMOOTHING = 0.3
+
+RE_WORD = re.compile(r"[A-Za-z_][A-Za-z_0-9]*")
+RE_START_WORD = re.compile(r"[A-Za-z_0-9]*$")
+
 class CustomCompletion:
     def __init__(self, name, type):
         self.full_name = ""
@@ -54,12 +100,6 @@ class CustomCompletion:
     def get_signatures(self):
         return self._signatures
 
-def addPatchCompletes(completion_list, patchApi):
-    for func_name, details in patchApi.items():
-        params = ', '.join(details['parameters'])
-        completion_name = f"{func_name}({params})"
-        completion_list.append(CustomCompletion(name=completion_name, type="function"))
-
 def addStateCompletes(list,document):
     try:
         targets = document._config.settings().get("targets")
@@ -78,20 +118,41 @@ def addStateCompletes(list,document):
         for m in messages:
             list.append(CustomCompletion(name=m, type="var"))
     except:
-        print("State not initialized")
+        log.debug("Sprite state not initialized")
         
 @hookimpl
 def pylsp_completions(config, document, position):
     """Get formatted completions for current code position"""
     settings = config.plugin_settings("jedi_completion", document_path=document.path)
-   
+    environment_path = config.plugin_settings("jedi", document_path=document.path).get(
+        "environment"
+    )
+
     resolve_eagerly = settings.get("eager", False)
     code_position = _utils.position_to_jedi_linecolumn(document, position)
 
     code_position["fuzzy"] = settings.get("fuzzy", False)
 
-    completions = document.jedi_script(use_document_path=True).complete(**code_position)
-    addPatchCompletes(completions,document._config.settings().get("apiData"))
+    deadline = settings.get("deadline", None)
+    with document.jedi_inference():
+        # Past its deadline, the completion goes on in the background
+        script = document.jedi_script(
+            use_document_path=True, detached=deadline is not None
+        )
+        # Read from jedi's tree before the script of a later version updates it
+        outside_import = use_snippets(
+            document, position, getattr(script, "_module_node", None)
+        )
+    exception_class_names = _exception_class_names(
+        environment_path, script._inference_state.environment
+    )
+    _cancel.check()
+    completions = _jedi_completions(document, script, code_position, deadline)
+    _cancel.check()
+    if completions is None:
+        # Jedi did not make it in time, answer with what is known without it
+        completions = _fallback_completions(config, document, position)
+        document.shared_data["COMPLETIONS_INCOMPLETE"] = True
     addStateCompletes(completions,document)
     
     if not completions:
@@ -110,36 +171,51 @@ def pylsp_completions(config, document, position):
     should_include_function_objects = settings.get("include_function_objects", False)
 
     max_to_resolve = settings.get("resolve_at_most", 25)
-    modules_to_cache_for = settings.get("cache_for", None)
-    if modules_to_cache_for is not None:
-        LABEL_RESOLVER.cached_modules = modules_to_cache_for
-        SNIPPET_RESOLVER.cached_modules = modules_to_cache_for
-
-    include_params = (
-        snippet_support and should_include_params and use_snippets(document, position)
-    )
-    include_class_objects = (
-        snippet_support
-        and should_include_class_objects
-        and use_snippets(document, position)
-    )
-    include_function_objects = (
+    resolve_time_budget = settings.get("resolve_time_budget", 0.1)
+    resolve_count = _resolve_count(max_to_resolve, resolve_time_budget)
+    # Without a time budget, eager resolution applies to every item
+    eager_count = resolve_count if resolve_time_budget is not None else len(completions)
+    # A no-op after the first call, e.g. at the startup of the server
+    _resolvers.configure(settings)
+
+    # The cursor context is analysed once per request and shared by all the
+    # snippet related options below.
+    snippets_allowed = (
         snippet_support
-        and should_include_function_objects
-        and use_snippets(document, position)
+        and (
+            should_include_params
+            or should_include_class_objects
+            or should_include_function_objects
+        )
+        and outside_import
     )
-
-    ready_completions = [
-        _format_completion(
-            c,
-            markup_kind=preferred_markup_kind,
-            include_params=include_params if c.type in ["class", "function"] else False,
-            resolve=resolve_eagerly,
-            resolve_label_or_snippet=(i < max_to_resolve),
-            snippet_support=snippet_support,
+    include_params = snippets_allowed and should_include_params
+    include_class_objects = snippets_allowed and should_include_class_objects
+    include_function_objects = snippets_allowed and should_include_function_objects
+
+    ready_completions = []
+    resolve_started = time.perf_counter()
+    for i, c in enumerate(completions):
+        if i == resolve_count:
+            _record_resolve_cost(time.perf_counter() - resolve_started, i)
+        if i < resolve_count:
+            # Resolving is the slow part of formatting
+            _cancel.check()
+        ready_completions.append(
+            _format_completion(
+                c,
+                markup_kind=preferred_markup_kind,
+                include_params=include_params
+                if c.type in ["class", "function"]
+                else False,
+                resolve=resolve_eagerly and i < eager_count,
+                resolve_label_or_snippet=(i < resolve_count),
+                snippet_support=snippet_support,
+                exception_class_names=exception_class_names,
+            )
         )
-        for i, c in enumerate(completions)
-    ]
+    if len(completions) <= resolve_count:
+        _record_resolve_cost(time.perf_counter() - resolve_started, len(completions))
 
     # TODO split up once other improvements are merged
     if include_class_objects:
@@ -149,9 +225,10 @@ def pylsp_completions(config, document, position):
                     c,
                     markup_kind=preferred_markup_kind,
                     include_params=False,
-                    resolve=resolve_eagerly,
-                    resolve_label_or_snippet=(i < max_to_resolve),
+                    resolve=resolve_eagerly and i < eager_count,
+                    resolve_label_or_snippet=(i < resolve_count),
                     snippet_support=snippet_support,
+                    exception_class_names=exception_class_names,
                 )
                 completion_dict["kind"] = lsp.CompletionItemKind.TypeParameter
                 completion_dict["label"] += " object"
@@ -164,9 +241,10 @@ def pylsp_completions(config, document, position):
                     c,
                     markup_kind=preferred_markup_kind,
                     include_params=True,
-                    resolve=resolve_eagerly,
-                    resolve_label_or_snippet=(i < max_to_resolve),
+                    resolve=resolve_eagerly and i < eager_count,
+                    resolve_label_or_snippet=(i < resolve_count),
                     snippet_support=snippet_support,
+                    exception_class_names=exception_class_names,
                 )
                 completion_dict["kind"] = lsp.CompletionItemKind.TypeParameter
                 completion_dict["label"] += " object"
@@ -189,10 +267,241 @@ def pylsp_completions(config, document, position):
     return ready_completions or None
 
 
+def _resolve_count(max_to_resolve, time_budget=None):
+    """
+    Return how many items to resolve eagerly.
+
+    The count is derived from the measured per-item resolution cost so that
+    resolving stays within `time_budget` seconds, and never exceeds
+    `max_to_resolve`. Without a budget, `max_to_resolve` is used as is.
+    """
+    per_item = _RESOLVE_COST["per_item"]
+    if time_budget is None or not per_item:
+        count = max_to_resolve
+    else:
+        count = max(1, min(max_to_resolve, int(time_budget / per_item)))
+    _metrics.set_gauge("jedi_completion.resolve_at_most", count)
+    return count
+
+
+def _record_resolve_cost(elapsed, resolved_items):
+    if not resolved_items:
+        return
+    per_item = elapsed / resolved_items
+    if _RESOLVE_COST["per_item"] is not None:
+        per_item = (
+            RESOLVE_COST_SMOOTHING * per_item
+            + (1 - RESOLVE_COST_SMOOTHING) * _RESOLVE_COST["per_item"]
+        )
+    _RESOLVE_COST["per_item"] = per_item
+    _metrics.set_gauge("jedi_completion.resolve_cost_ms", per_item * 1000)
+    _metrics.set_gauge("jedi_completion.resolved_items", resolved_items)
+
+
+def _jedi_completions(document, script, code_position, deadline=None):
+    """
+    Get the jedi completions, waiting at most `deadline` seconds for them.
+
+    Completions already computed, or being computed, in the background for
+    the same document version and position are used when available. Returns
+    `None` when the deadline passed; inference then finishes in the
+    background and answers the next request for the same position.
+    """
+    key = _completion_key(document.version, code_position)
+    warm = _warm_completions(document)
+    future = warm.pop(key, None)
+    if future is not None and future.cancel():
+        # Still queued behind less urgent work, computed right away instead
+        _SPECULATION_TOKENS.pop(future, None)
+        future = None
+    # Completions computed ahead for other positions are outdated by now
+    for other_key in list(warm):
+        _cancel_speculation(warm.pop(other_key, None))
+    _executor, pending_completions = _completion_worker(document)
+    for pending in list(pending_completions):
+        pending.cancel()
+
+    if future is not None:
+        _metrics.increment("jedi_completion.warm_hits")
+    else:
+        if deadline is None:
+            with document.jedi_inference():
+                return script.complete(**code_position)
+        future = _submit_completion(document, script.complete, **code_position)
+    try:
+        return list(_cancel.result(future, timeout=deadline))
+    except FutureTimeoutError:
+        log.debug(f"Jedi completions exceeded the {deadline}s deadline")
+        _warm_completions(document)[key] = future
+        return None
+    except _cancel.RequestCancelled:
+        # Inference cannot be interrupted, its result may serve the next request
+        if not future.cancel():
+            _warm_completions(document)[key] = future
+        raise
+
+
+def _completion_worker(document):
+    """Return the executor and pending futures of the document's workspace."""
+    workspace = document._workspace
+    with _COMPLETION_WORKERS_LOCK:
+        worker = _COMPLETION_WORKERS.get(workspace)
+        if worker is None:
+            executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="jedi_completion"
+            )
+            worker = _COMPLETION_WORKERS[workspace] = (executor, set())
+    return worker
+
+
+def _submit_completion(document, fn, *args, **kwargs):
+    executor, pending_completions = _completion_worker(document)
+    future = executor.submit(fn, *args, **kwargs)
+    pending_completions.add(future)
+    future.add_done_callback(pending_completions.discard)
+    return future
+
+
+def _completion_key(version, code_position):
+    return (
+        version,
+        code_position["line"],
+        code_position["column"],
+        code_position.get("fuzzy", False),
+    )
+
+
+def _warm_completions(document):
+    """Futures of completions computed ahead of a request, by position."""
+    return document.shared_data.setdefault("WARM_JEDI_COMPLETIONS", {})
+
+
+@hookimpl
+def pylsp_document_did_change(config, document, changes):
+    """Start computing completions where the next request is likely to be."""
+    settings = config.plugin_settings("jedi_completion", document_path=document.path)
+    # Completions are computed for this version, even if the document changes
+    snapshot = document.snapshot()
+    warm = _warm_completions(document)
+    for key in [key for key in warm if key[0] != snapshot.version]:
+        _cancel_speculation(warm.pop(key, None))
+    if not settings.get("precompute", True):
+        return
+
+    for position in _trigger_positions(snapshot, changes):
+        code_position = _utils.position_to_jedi_linecolumn(snapshot, position)
+        code_position["fuzzy"] = settings.get("fuzzy", False)
+        key = _completion_key(snapshot.version, code_position)
+        if key not in warm:
+            warm[key] = _speculate(document, snapshot, code_position)
+
+
+def _trigger_positions(snapshot, changes):
+    """
+    Predict where completions will be requested after `changes`.
+
+    Those are the cursor right after a typed `.`, and the start of a new line
+    once the indentation has been inserted.
+    """
+    if not changes or "range" not in changes[-1]:
+        return []
+    change = changes[-1]
+    text = change["text"]
+    start = change["range"]["start"]
+    if "\n" in text:
+        line = start["line"] + text.count("\n")
+        character = len(text.rsplit("\n", 1)[1])
+    else:
+        line = start["line"]
+        character = start["character"] + len(text)
+
+    lines = snapshot.lines
+    if line >= len(lines):
+        return []
+    before = lines[line][:character]
+    if before.endswith(".") or ("\n" in text and not before.strip()):
+        return [{"line": line, "character": character}]
+    return []
+
+
+def _speculate(document, snapshot, code_position):
+    """Compute completions ahead of a request, behind the requests of sessions."""
+    token = _cancel.Token()
+    future = _scheduler.SCHEDULER.submit(
+        "workspace", _speculative_completions, token, document, snapshot, code_position
+    )
+    _SPECULATION_TOKENS[future] = token
+    return future
+
+
+def _cancel_speculation(future):
+    """Drop a speculative completion, before its inference if still possible."""
+    if future is None:
+        return
+    future.cancel()
+    token = _SPECULATION_TOKENS.pop(future, None)
+    if token is not None:
+        token.cancel()
+
+
+def _speculative_completions(token, document, snapshot, code_position):
+    with _cancel.use(token):
+        _cancel.check()
+        if document.version != snapshot.version:
+            # The document changed again before this got to run
+            return []
+        script = document.jedi_script(
+            use_document_path=True, snapshot=snapshot, detached=True
+        )
+        _cancel.check()
+        return script.complete(**code_position)
+
+
+def _fallback_completions(config, document, position):
+    """Completions that need no inference: Patch API and document names."""
+    lines = document.lines
+    line = lines[position["line"]] if position["line"] < len(lines) else ""
+    before = line[: position["character"]]
+    prefix = RE_START_WORD.findall(before)[0].lower()
+    is_attribute = before[: len(before) - len(prefix)].rstrip().endswith(".")
+
+    completions = []
+    names = set()
+    if not is_attribute:
+        for name, entry in _patch_api.api_index(config).items():
+            if entry["type"] == "function" and name.lower().startswith(prefix):
+                completions.append(CustomCompletion(name=name, type="function"))
+                names.add(name)
+
+    for name in RE_WORD.findall(document.source):
+        if (
+            name in names
+            or keyword.iskeyword(name)
+            or len(name) <= len(prefix)
+            or not name.lower().startswith(prefix)
+        ):
+            continue
+        completions.append(CustomCompletion(name=name, type="statement"))
+        names.add(name)
+    return completions
+
+
+@hookimpl
+def pylsp_workspace_configuration_changed(workspace, changed_keys):
+    """Drop the completions computed ahead with settings that changed."""
+    if not changed_keys & COMPLETION_SETTINGS:
+        return
+    for document in list(workspace.documents.values()):
+        warm = getattr(document, "shared_data", {}).pop("WARM_JEDI_COMPLETIONS", {})
+        for future in warm.values():
+            future.cancel()
+
+
 @hookimpl
 def pylsp_completion_item_resolve(config, completion_item, document):
     """Resolve formatted completion for given non-resolved completion"""
-    shared_data = document.shared_data["LAST_JEDI_COMPLETIONS"].get(
+    # Missing once the caches of an idle session were shed
+    shared_data = document.shared_data.get("LAST_JEDI_COMPLETIONS", {}).get(
         completion_item["label"]
     )
 
@@ -209,55 +518,101 @@ def pylsp_completion_item_resolve(config, completion_item, document):
     return completion_item
 
 
-def is_exception_class(name):
+def _builtin_exception_names():
+    return {
+        name
+        for name, value in vars(builtins).items()
+        if isinstance(value, type) and issubclass(value, BaseException)
+    }
+
+
+def _exception_class_names(environment_path=None, environment=None):
+    """
+    Return the names of the exception classes of a jedi environment.
+
+    These are the builtin exceptions of the server, plus those of the
+    interpreter of `environment` when it is not the server's own. The set is
+    built once per `plugins.jedi.environment` setting, so lookups stay O(1)
+    per item.
+    """
+    if environment_path not in _EXCEPTION_CLASS_NAMES:
+        names = _builtin_exception_names()
+        executable = getattr(environment, "executable", None)
+        if executable and executable != sys.executable:
+            try:
+                names.update(
+                    subprocess.run(
+                        [executable, "-c", _EXCEPTION_NAMES_SCRIPT],
+                        capture_output=True,
+                        check=True,
+                        text=True,
+                        timeout=_EXCEPTION_NAMES_TIMEOUT_S,
+                    ).stdout.split()
+                )
+            except (OSError, subprocess.SubprocessError) as e:
+                log.warning(f"Failed to list the exceptions of {executable}: {e}")
+        _EXCEPTION_CLASS_NAMES[environment_path] = frozenset(names)
+    return _EXCEPTION_CLASS_NAMES[environment_path]
+
+
+def is_exception_class(name, exception_class_names=None):
     """
     Determine if a class name is an instance of an Exception.
 
-    This returns `False` if the name given corresponds with a instance of
-    the 'Exception' class, `True` otherwise
+    This returns `True` if the name given corresponds with a class in the
+    exception hierarchy, `False` otherwise
     """
-    try:
-        return name in [cls.__name__ for cls in Exception.__subclasses__()]
-    except AttributeError:
-        # Needed in case a class don't uses new-style
-        # class definition in Python 2
-        return False
+    if exception_class_names is None:
+        exception_class_names = _exception_class_names()
+    return name in exception_class_names
 
 
-def use_snippets(document, position):
+def use_snippets(document, position, module_node=None):
     """
     Determine if it's necessary to return snippets in code completions.
 
     This returns `False` if a completion is being requested on an import
     statement, `True` otherwise.
+
+    The import context is read from the parso tree jedi already built for the
+    document when given, otherwise from the one shared for its version.
     """
-    line = position["line"]
-    lines = document.source.split("\n", line)
-    act_lines = [lines[line][: position["character"]]]
-    line -= 1
-    last_character = ""
-    while line > -1:
-        act_line = lines[line]
-        if (
-            act_line.rstrip().endswith("\\")
-            or act_line.rstrip().endswith("(")
-            or act_line.rstrip().endswith(",")
-        ):
-            act_lines.insert(0, act_line)
-            line -= 1
-            if act_line.rstrip().endswith("("):
-                # Needs to be added to the end of the code before parsing
-                # to make it valid, otherwise the node type could end
-                # being an 'error_node' for multi-line imports that use '('
-                last_character = ")"
-        else:
-            break
-    if "(" in act_lines[-1].strip():
-        last_character = ")"
-    code = "\n".join(act_lines).rsplit(";", maxsplit=1)[-1].strip() + last_character
-    tokens = parso.parse(code)
-    expr_type = tokens.children[0].type
-    return expr_type not in _IMPORTS and not (expr_type in _ERRORS and "import" in code)
+    if module_node is None:
+        module_node = document.snapshot().parso_module()
+    return not _in_import_context(module_node, position)
+
+
+def _in_import_context(module_node, position):
+    """Check in a parso module tree whether the cursor is inside an import."""
+    code_position = (position["line"] + 1, position["character"])
+    try:
+        leaf = module_node.get_leaf_for_position(code_position, include_prefixes=True)
+    except ValueError:
+        leaf = None
+    if leaf is None or leaf.start_pos >= code_position:
+        # The cursor is in whitespace, so what matters is what precedes it
+        leaf = leaf.get_previous_leaf() if leaf else module_node.get_last_leaf()
+
+    node = leaf
+    while node is not None and node.type != "file_input":
+        if node.type in _IMPORTS:
+            return True
+        if node.type in _ERRORS:
+            # Incomplete imports end up in error nodes, together with any
+            # statement before them on the same line, so look back from the
+            # cursor to the start of the statement only.
+            prev = leaf
+            while prev is not None and prev.start_pos >= node.start_pos:
+                if prev.type == "newline" or (
+                    prev.type == "operator" and prev.value == ";"
+                ):
+                    break
+                if prev.type == "keyword" and prev.value in ("import", "from"):
+                    return True
+                prev = prev.get_previous_leaf()
+            return False
+        node = node.parent
+    return False
 
 
 def _resolve_completion(completion, d, markup_kind: str):
@@ -281,6 +636,7 @@ def _format_completion(
     resolve=False,
     resolve_label_or_snippet=False,
     snippet_support=False,
+    exception_class_names=None,
 ):
     completion = {
         "label": _label(d, resolve_label_or_snippet),
@@ -312,7 +668,7 @@ def _format_completion(
 
         completion["insertText"] = path
 
-    if include_params and not is_exception_class(d.name):
+    if include_params and not is_exception_class(d.name, exception_class_names):
         snippet = _snippet(d, resolve_label_or_snippet)
         completion.update(snippet)
 
@@ -0,0 +1,256 @@
+# Copyright 2021- Python Language Server Contributors.
+
+"""Plugins registered without importing them.
+
+Importing every plugin of the ``pylsp`` entry point group is slow, and wasted
+on the plugins that are disabled. Instead, each plugin is registered as a
+`LazyPlugin`, whose hooks import the plugin module the first time one of
+them is called. Disabled plugins are never called, so never imported.
+
+Registering a hook needs its options and argument names, and the settings of
+every plugin are collected at startup. Both are read from a manifest written
+by `write_manifest`, e.g. while building the image. Plugins missing from the
+manifest, or whose module changed since, are imported right away as before.
+The ``pylsp_settings`` hooks of the plugins in this repo take no argument,
+so the settings they return are recorded in the manifest too.
+"""
+
+import copy
+import importlib
+import importlib.util
+import inspect
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from importlib.metadata import distributions
+
+import pluggy
+
+from pylsp import PYLSP, _metrics, hookimpl
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MANIFEST_PATH = os.path.join(sys.prefix, "share", "pylsp", "plugins.json")
+
+# Bump when the layout of the manifest changes
+MANIFEST_VERSION = 1
+
+_lock = threading.Lock()
+# Plugins by group, shared by all the configs of the process
+_plugins = {}
+
+
+class LazyPlugin:
+    """Stands in for a plugin module until one of its hooks is called."""
+
+    def __init__(self, name, module_name, hooks, settings=None):
+        self.name = name
+        self.module_name = module_name
+        self._module = None
+        self._lock = threading.Lock()
+        for hook_name, hook in hooks.items():
+            if hook_name == "pylsp_settings" and settings is not None:
+                stub = _settings_stub(settings)
+            else:
+                stub = self._stub(hook_name, hook["args"], hook["opts"])
+            setattr(self, hook_name, stub)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy plugin {self.module_name!r} ({state})>"
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def load(self):
+        """Import the plugin module, once."""
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = _import(self.name, self.module_name)
+        return self._module
+
+    def _stub(self, hook_name, args, opts):
+        if opts.get("hookwrapper") or opts.get("wrapper"):
+
+            def stub(*hook_args):
+                impl = getattr(self.load(), hook_name)
+                return (yield from impl(*hook_args))
+
+        else:
+
+            def stub(*hook_args):
+                return getattr(self.load(), hook_name)(*hook_args)
+
+        # pluggy calls hooks with the arguments named in their signature
+        stub.__name__ = hook_name
+        stub.__signature__ = inspect.Signature(
+            [
+                inspect.Parameter(arg, inspect.Parameter.POSITIONAL_OR_KEYWORD)
+                for arg in args
+            ]
+        )
+        return hookimpl(**opts)(stub)
+
+
+def _settings_stub(settings):
+    def pylsp_settings():
+        return copy.deepcopy(settings)
+
+    return hookimpl(pylsp_settings)
+
+
+def _import(name, module_name):
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    _metrics.set_gauge(f"plugins.{name}.import_ms", round(elapsed_ms, 1))
+    log.info("Imported plugin %s in %.0f ms", name, elapsed_ms)
+    return module
+
+
+def plugins(group, manifest_path=DEFAULT_MANIFEST_PATH):
+    """Return the names and objects of the plugins of entry point `group`.
+
+    Plugins that fail to import are left out.
+    """
+    with _lock:
+        if group not in _plugins:
+            _plugins[group] = _load_plugins(group, manifest_path)
+        return _plugins[group]
+
+
+def _load_plugins(group, manifest_path):
+    manifest = _read_manifest(manifest_path)
+    result = []
+    seen = set()
+    for entry_point in _entry_points(group):
+        if entry_point.name in seen:
+            continue
+        seen.add(entry_point.name)
+
+        entry = manifest.get(entry_point.name)
+        if entry is not None and _is_current(entry, entry_point.value):
+            plugin = LazyPlugin(
+                entry_point.name,
+                entry_point.value,
+                entry["hooks"],
+                entry.get("settings"),
+            )
+            result.append((entry_point.name, plugin))
+            continue
+
+        # Filter out any entry points that throw ImportError, assuming one or
+        # more of their dependencies isn't present.
+        try:
+            module = _import(entry_point.name, entry_point.value)
+        except Exception as e:  # pylint: disable=broad-except
+            log.info(
+                "Failed to load %s entry point '%s': %s", group, entry_point.name, e
+            )
+            continue
+        result.append((entry_point.name, module))
+    return result
+
+
+def _module_stat(module_name):
+    try:
+        spec = importlib.util.find_spec(module_name)
+    except (ImportError, ValueError):
+        return None
+    if spec is None or not spec.origin or not os.path.isfile(spec.origin):
+        return None
+    stat = os.stat(spec.origin)
+    return [spec.origin, stat.st_mtime_ns, stat.st_size]
+
+
+def _is_current(entry, module_name):
+    if entry.get("module") != module_name:
+        return False
+    return entry.get("stat") == _module_stat(module_name)
+
+
+def _read_manifest(manifest_path):
+    try:
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        log.debug("No plugin manifest at %s", manifest_path)
+        return {}
+    except (OSError, ValueError) as e:
+        log.warning("Could not read the plugin manifest %s: %s", manifest_path, e)
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest.get("plugins", {})
+
+
+def write_manifest(group=PYLSP, manifest_path=DEFAULT_MANIFEST_PATH):
+    """Import the plugins of `group` and record what registering them needs."""
+    manifest = {}
+    for entry_point in _entry_points(group):
+        if entry_point.name in manifest:
+            continue
+        try:
+            module = importlib.import_module(entry_point.value)
+        except Exception as e:  # pylint: disable=broad-except
+            log.info("Not recording entry point '%s': %s", entry_point.name, e)
+            continue
+        manifest[entry_point.name] = _manifest_entry(entry_point.value, module)
+
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump({"version": MANIFEST_VERSION, "plugins": manifest}, f, indent=1)
+    log.info("Recorded %d plugins in %s", len(manifest), manifest_path)
+    return manifest
+
+
+def _entry_points(group):
+    # Same order as pluggy's load_setuptools_entrypoints
+    for dist in list(distributions()):
+        for entry_point in dist.entry_points:
+            if entry_point.group == group:
+                yield entry_point
+
+
+def _manifest_entry(module_name, module):
+    hooks = {}
+    for attr in dir(module):
+        impl = getattr(module, attr)
+        opts = getattr(impl, f"{PYLSP}_impl", None)
+        if not inspect.isroutine(impl) or not isinstance(opts, dict):
+            continue
+        args, _kwargs = pluggy._hooks.varnames(impl)  # pylint: disable=protected-access
+        hooks[attr] = {"args": list(args), "opts": dict(opts)}
+
+    entry = {"module": module_name, "stat": _module_stat(module_name), "hooks": hooks}
+    if "pylsp_settings" in hooks and not hooks["pylsp_settings"]["args"]:
+        try:
+            settings = module.pylsp_settings()
+            json.dumps(settings)
+        except Exception as e:  # pylint: disable=broad-except
+            log.info("Not recording the settings of %s: %s", module_name, e)
+        else:
+            entry["settings"] = settings
+    return entry
+
+
+def load_enabled(config):
+    """Import the plugins of `config` that are not disabled."""
+    for _name, plugin in config.plugin_manager.list_name_plugin():
+        if isinstance(plugin, LazyPlugin) and plugin not in config.disabled_plugins:
+            plugin.load()
+
+
+def import_report():
+    """Return the names of the plugins, with their import time in ms if loaded."""
+    gauges = _metrics.snapshot()["gauges"]
+    report = {}
+    for group_plugins in _plugins.values():
+        for name, _plugin in group_plugins:
+            report[name] = gauges.get(f"plugins.{name}.import_ms")
+    return report
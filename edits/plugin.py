@@ -1,10 +1,11 @@
 import enum
+import functools
 import json
 import logging
 import re
 import sys
 from pathlib import PurePath
-from subprocess import PIPE, Popen
+from subprocess import PIPE, Popen, run
 from typing import Dict, Generator, List, Optional
 
 if sys.version_info >= (3, 11):
@@ -24,7 +25,7 @@ from lsprotocol.types import (
     TextEdit,
     WorkspaceEdit,
 )
-from pylsp import hookimpl
+from pylsp import _cancel, _patch_api, hookimpl
 from pylsp._utils import find_parents
 from pylsp.config.config import Config
 from pylsp.workspace import Document, Workspace
@@ -39,6 +40,10 @@ converter = get_converter()
 
 DIAGNOSTIC_SOURCE = "ruff"
 
+# Oldest ruff the plugin works with
+MINIMUM_RUFF_VERSION = (0, 2, 0)
+RUFF_VERSION_REGEX = re.compile(r"ruff (\d+)\.(\d+)\.(\d+)")
+
 # shamelessly borrowed from:
 # https://github.com/charliermarsh/ruff-lsp/blob/2a0e2ea3afefdbf00810b8df91030c1c6b59d103/ruff_lsp/server.py#L214
 NOQA_REGEX = re.compile(
@@ -46,10 +51,6 @@ NOQA_REGEX = re.compile(
     r"(?::\s?(?P<codes>([A-Z]+[0-9]+(?:[,\s]+)?)+))?"
 )
 
-#list of valid Patch functions to ignore
-CUSTOM_VALID_FUNCTIONS = []
-
-
 UNNECESSITY_CODES = {
     "F401",  # `module` imported but unused
     "F504",  # % format unused named arguments
@@ -89,6 +90,12 @@ class Subcommand(str, enum.Enum):
         return []
 
 
+@hookimpl
+def pylsp_initialize():
+    # Resolved once per process, so that the first lint does not pay for it
+    find_ruff_binary()
+
+
 @hookimpl
 def pylsp_settings():
     log.debug("Initializing pylsp_ruff")
@@ -160,26 +167,6 @@ def pylsp_format_document(workspace: Workspace, document: Document) -> Generator
 
     outcome.force_result(converter.unstructure([text_edit]))
 
-def addStateValidations(list,document):
-    try:
-        targets = document._config.settings().get("targets")
-        backdrops = document._config.settings().get("backdrops")
-        costumes = document._config.settings().get("costumes")
-        sounds = document._config.settings().get("sounds")
-        messages = document._config.settings().get("messages")
-        for t in targets:
-            list.append(t)
-        for b in backdrops:
-            list.append(b)
-        for c in costumes:
-            list.append(c)
-        for s in sounds:
-            list.append(s)
-        for m in messages:
-            list.append(m)
-    except:
-        print("State not initialized")
-
 @hookimpl
 def pylsp_lint(workspace: Workspace, document: Document) -> List[Dict]:
     """Register ruff as the linter.
@@ -196,14 +183,9 @@ def pylsp_lint(workspace: Workspace, document: Document) -> List[Dict]:
     List of dicts containing the diagnostics.
 
     """
-    try:
-        for func in document._config.settings().get("apiData"):
-            CUSTOM_VALID_FUNCTIONS.append(func)
-    except:
-        print("Api Data not yet loaded")
+    # Patch functions and sprite state names of this session
+    custom_names = list(_patch_api.api_index(document._config))
 
-    addStateValidations(CUSTOM_VALID_FUNCTIONS,document)
-    
     settings = load_settings(workspace, document.path)
     checks = run_ruff_check(document=document, settings=settings)
     # Only get diagnostics for valid errors, not Patch function errors
@@ -212,7 +194,7 @@ def pylsp_lint(workspace: Workspace, document: Document) -> List[Dict]:
         isError = True
         #Checks if a naming error
         if (c.code == "F821"):
-            for n in CUSTOM_VALID_FUNCTIONS:
+            for n in custom_names:
                 if n in c.message:
                     isError = False
         if isError:
@@ -554,6 +536,8 @@ def run_ruff(
 
     """
     executable = settings.executable
+    if executable is None:
+        executable = find_ruff_binary()
 
     arguments = subcommand.build_args(document_path, settings, fix, extra_arguments)
 
@@ -574,7 +558,10 @@ def run_ruff(
         cmd = [sys.executable, "-m", "ruff", str(subcommand)]
         cmd.extend(arguments)
         p = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-    (stdout, stderr) = p.communicate(document_source.encode())
+    # Kill ruff as soon as its result is not needed anymore
+    with _cancel.on_cancel(p.kill):
+        (stdout, stderr) = p.communicate(document_source.encode())
+    _cancel.check()
 
     if p.returncode != 0:
         log.error(f"Error running ruff: {stderr.decode()}")
@@ -582,6 +569,45 @@ def run_ruff(
     return stdout.decode()
 
 
+@functools.lru_cache(maxsize=None)
+def find_ruff_binary() -> Optional[str]:
+    """Locate the ruff binary of the installed ruff package, and check its version.
+
+    Running the binary directly saves starting a Python interpreter for
+    `python -m ruff` on every call. Errors are only reported once.
+
+    Returns
+    -------
+    Path to the ruff binary, or None if it is missing or too old.
+
+    """
+    try:
+        try:
+            from ruff import find_ruff_bin
+        except ImportError:
+            from ruff.__main__ import find_ruff_bin
+
+        binary = str(find_ruff_bin())
+        output = run(
+            [binary, "--version"], capture_output=True, text=True, timeout=10
+        ).stdout
+    except Exception as e:
+        log.error(f"Can't find the ruff binary, falling back to python -m ruff: {e}")
+        return None
+
+    match = RUFF_VERSION_REGEX.search(output)
+    version = tuple(int(part) for part in match.groups()) if match else None
+    if version is None or version < MINIMUM_RUFF_VERSION:
+        log.error(
+            f"Unsupported ruff binary '{binary}' ({output.strip()}), "
+            f"falling back to python -m ruff"
+        )
+        return None
+
+    log.info(f"Using ruff {'.'.join(map(str, version))} from '{binary}'")
+    return binary
+
+
 def build_check_arguments(
     document_path: str,
     settings: PluginSettings,
@@ -2,11 +2,14 @@
 # Copyright 2021- Python Language Server Contributors.
 
 import builtins
+import copy
+import hashlib
+import os
 import types
-from pyflakes import api as pyflakes_api
 from pyflakes import messages
 
-from pylsp import hookimpl, lsp
+from pylsp import _cancel, _metrics, _parse, _patch_api, _pool, hookimpl, lsp
+from pylsp.plugins import _flakes
 
 # for variable parsing
 import ast
@@ -25,57 +28,63 @@ PYFLAKES_ERROR_MESSAGES = (
     messages.TwoStarredExpressions,
 )
 
-# List of Patch functions  
-CUSTOM_VALID_FUNCTIONS = []
-
-
 # Gets all Python key words and functions
 PYTHON_KEY_WORDS = [name for name, obj in vars(builtins).items() 
                           if not isinstance(obj, types.BuiltinFunctionType)]
 PYTHON_FUNCTIONS =  [name for name, obj in vars(builtins).items() 
                           if isinstance(obj, types.BuiltinFunctionType)]
 
-def addStateValidations(list,document):
-    try:
-        targets = document._config.settings().get("targets")
-        backdrops = document._config.settings().get("backdrops")
-        costumes = document._config.settings().get("costumes")
-        sounds = document._config.settings().get("sounds")
-        messages = document._config.settings().get("messages")
-        for t in targets:
-            list.append(t)
-        for b in backdrops:
-            list.append(b)
-        for c in costumes:
-            list.append(c)
-        for s in sounds:
-            list.append(s)
-        for m in messages:
-            list.append(m)
-    except:
-        print("State not initialized")
-
 @hookimpl
 def pylsp_lint(workspace, document):
-    try:
-        for func in document._config.settings().get("apiData"):
-            CUSTOM_VALID_FUNCTIONS.append(func)
-    except:
-        print("Api Data not yet loaded")
-    addStateValidations(CUSTOM_VALID_FUNCTIONS,document)
+    # One version of the document, parsed once for every plugin
+    snapshot = document.snapshot()
+    # Diagnostics only depend on the source, whether it is the __init__.py of
+    # a package, and the Patch API names
+    key = (
+        hashlib.sha1(snapshot.source.encode("utf-8")).hexdigest(),
+        os.path.basename(document.path) == "__init__.py",
+        _patch_api.api_index_key(document._config),
+    )
+    diagnostics = _flakes.REPORTS.get(key)
+    if diagnostics is not None:
+        _metrics.increment("pyflakes.reports_cached")
+        return copy.deepcopy(diagnostics)
+
+    # Patch functions and sprite state names of this session
+    custom_names = list(_patch_api.api_index(document._config))
     with workspace.report_progress("lint: pyflakes"):
-        reporter = PyflakesDiagnosticReport(document.lines)
-        pyflakes_api.check(
-            document.source.encode("utf-8"), document.path, reporter=reporter
-        )
-        return reporter.diagnostics
+        if _pool.POOL is None:
+            diagnostics = lint_source(
+                snapshot.source, document.path, custom_names, snapshot
+            )
+        else:
+            # The process linting the document keeps its function bodies
+            diagnostics = _pool.run(
+                document.uri, lint_source, snapshot.source, document.path, custom_names
+            )
+    _metrics.increment("pyflakes.reports_built")
+    _flakes.REPORTS.put(key, diagnostics)
+    return copy.deepcopy(diagnostics)
+
+
+def lint_source(source, path, custom_names, parsed=None):
+    """Return the diagnostics of `source`, also in the processes of the pool."""
+    if parsed is None:
+        parsed = _parse.Snapshot(source)
+    reporter = PyflakesDiagnosticReport(parsed.lines, custom_names, parsed)
+    # Function bodies unchanged since an earlier pass are not checked again
+    _flakes.check(parsed, path, reporter)
+    return reporter.diagnostics
 
 
 class PyflakesDiagnosticReport:
-    def __init__(self, lines):
+    def __init__(self, lines, custom_names=None, parsed=None):
         self.lines = lines
+        self.custom_names = custom_names or []
         self.diagnostics = []
         self.source = '\n'.join([str(item) for item in lines])
+        # Parse artifacts of the source, to reuse its ast tree
+        self.parsed = parsed
 
     def unexpectedError(self, _filename, msg):  # pragma: no cover
         err_range = {
@@ -114,6 +123,8 @@ class PyflakesDiagnosticReport:
 
     def flake(self, message):
         """Get message like <filename>:<lineno>: <msg>"""
+        # Stops reporting, and its suggestion search, once the lint is outdated
+        _cancel.check()
         err_range = {
             "start": {"line": message.lineno - 1, "character": message.col},
             "end": {
@@ -164,7 +175,7 @@ class PyflakesDiagnosticReport:
         errorName = message.message_args[0]
         if (message_type == messages.UndefinedName):
             #First we determine if the error is a valid custom funcion in which case we throw no error
-            if (errorName in set(CUSTOM_VALID_FUNCTIONS)):
+            if (errorName in set(self.custom_names)):
                 return
             
             #Now determine if the error happens at a function (by parsing for parentheses)
@@ -174,7 +185,7 @@ class PyflakesDiagnosticReport:
                 isFun = True
 
             #Now parse the syntax tree to get all customly defined variable/function names in the source code
-            root = ast.parse(self.source)
+            root = self.parsed.ast() if self.parsed else ast.parse(self.source)
             funs = list({
                 node.value.func.id: None for node in ast.walk(root)
                 if isinstance(node, ast.Expr) and hasattr(node, 'value') and isinstance(node.value, ast.Call) and hasattr(node.value.func, 'id')
@@ -190,11 +201,12 @@ class PyflakesDiagnosticReport:
             if (checkSet.count(errorName) <= 1):
                 instructStr = "defining" if isFun else "assigning a value to"
                 msg += "Try " + instructStr + " \'" + errorName + "\' before using it. "
-            namesSet = set(checkSet).difference(set(CUSTOM_VALID_FUNCTIONS))
-            namesSet.discard(errorName)
+            # In source order, so that every process suggests the same name
+            customSet = set(self.custom_names)
+            namesSet = [m for m in checkSet if m not in customSet and m != errorName]
 
             #First check for misspelled builtin words
-            for m in (CUSTOM_VALID_FUNCTIONS + PYTHON_FUNCTIONS if isFun else PYTHON_KEY_WORDS):
+            for m in (self.custom_names + PYTHON_FUNCTIONS if isFun else PYTHON_KEY_WORDS):
                 if (m.upper() == errorName.upper() or almost_equal(m, errorName)):
                     msg += "Did you mean \'" + m + "\' instead of \'" + errorName + "\'? "
                     break
@@ -0,0 +1,1369 @@
+# Copyright 2017-2020 Palantir Technologies, Inc.
+# Copyright 2021- Python Language Server Contributors.
+
+import logging
+import os
+import secrets
+import socketserver
+import threading
+import time
+import uuid
+import weakref
+from functools import partial
+from typing import Any, Dict, List
+
+import ujson as json
+from pylsp_jsonrpc.dispatchers import MethodDispatcher
+from pylsp_jsonrpc.streams import JsonRpcStreamReader, JsonRpcStreamWriter
+
+from . import (
+    _cancel,
+    _metrics,
+    _patch_api,
+    _pool,
+    _prefork,
+    _scheduler,
+    _sessions,
+    _utils,
+    _warmup,
+    lsp,
+    uris,
+)
+from ._shared import content_key
+from ._version import __version__
+from .config import config
+from .workspace import Cell, Document, Notebook, Workspace
+
+log = logging.getLogger(__name__)
+
+
+LINT_DEBOUNCE_S = 0.5  # 500 ms
+PARENT_PROCESS_WATCH_INTERVAL = 10  # 10 s
+MAX_WORKERS = 64
+PYTHON_FILE_EXTENSIONS = (".py", ".pyi")
+# Hooks running jedi on the document, which hold its path while they do
+JEDI_HOOKS = frozenset(
+    (
+        "pylsp_completions",
+        "pylsp_completion_item_resolve",
+        "pylsp_definitions",
+        "pylsp_document_highlight",
+        "pylsp_document_symbols",
+        "pylsp_hover",
+        "pylsp_references",
+        "pylsp_rename",
+        "pylsp_signature_help",
+    )
+)
+CONFIG_FILEs = ("pycodestyle.cfg", "setup.cfg", "tox.ini", ".flake8")
+# Path of the websocket server answering readiness probes
+HEALTH_PATH = "/health"
+# Seconds between two reviews of the websocket sessions
+REAP_INTERVAL_S = 30
+# Idle sessions shed their caches after this fraction of the idle timeout
+IDLE_SHED_FRACTION = 0.5
+# Websocket close codes telling clients why their session was closed
+SESSION_CLOSE_CODES = {"idle": 4000, "memory": 4001}
+
+# Lint config key of each config, with the settings it was derived from
+_LINT_CONFIG_KEYS = weakref.WeakKeyDictionary()
+
+# Settings the diagnostics depend on, besides the sections of the lint plugins
+LINT_SETTINGS = frozenset(("configurationSources", "apiData", *_patch_api.STATE_KINDS))
+
+# Live websocket sessions by id. Each has its own server, and thus its own
+# workspaces, documents and config.
+SESSIONS = {}
+
+
+class _StreamHandlerWrapper(socketserver.StreamRequestHandler):
+    """A wrapper class that is used to construct a custom handler class."""
+
+    delegate = None
+
+    def setup(self):
+        super().setup()
+        self.delegate = self.DELEGATE_CLASS(self.rfile, self.wfile)
+
+    def handle(self):
+        try:
+            self.delegate.start()
+        except OSError as e:
+            if os.name == "nt":
+                # Catch and pass on ConnectionResetError when parent process
+                # dies
+                if isinstance(e, WindowsError) and e.winerror == 10054:
+                    pass
+
+        self.SHUTDOWN_CALL()
+
+
+def start_tcp_lang_server(bind_addr, port, check_parent_process, handler_class):
+    if not issubclass(handler_class, PythonLSPServer):
+        raise ValueError("Handler class must be an instance of PythonLSPServer")
+
+    def shutdown_server(check_parent_process, *args):
+        if check_parent_process:
+            log.debug("Shutting down server")
+            # Shutdown call must be done on a thread, to prevent deadlocks
+            stop_thread = threading.Thread(target=server.shutdown)
+            stop_thread.start()
+
+    # Construct a custom wrapper class around the user's handler_class
+    wrapper_class = type(
+        handler_class.__name__ + "Handler",
+        (_StreamHandlerWrapper,),
+        {
+            "DELEGATE_CLASS": partial(
+                handler_class, check_parent_process=check_parent_process
+            ),
+            "SHUTDOWN_CALL": partial(shutdown_server, check_parent_process),
+        },
+    )
+
+    server = socketserver.TCPServer(
+        (bind_addr, port), wrapper_class, bind_and_activate=False
+    )
+    server.allow_reuse_address = True
+
+    try:
+        server.server_bind()
+        server.server_activate()
+        log.info("Serving %s on (%s, %s)", handler_class.__name__, bind_addr, port)
+        server.serve_forever()
+    finally:
+        log.info("Shutting down")
+        server.server_close()
+
+
+def start_io_lang_server(rfile, wfile, check_parent_process, handler_class):
+    if not issubclass(handler_class, PythonLSPServer):
+        raise ValueError("Handler class must be an instance of PythonLSPServer")
+    log.info("Starting %s IO language server", handler_class.__name__)
+    server = handler_class(rfile, wfile, check_parent_process)
+    server.start()
+
+
+def start_ws_lang_server(
+    port,
+    check_parent_process,
+    handler_class,
+    workers=1,
+    max_worker_memory=None,
+    session_idle_timeout=None,
+    session_max_memory=None,
+    session_resume_ttl=None,
+    analysis_processes=0,
+):
+    """Serve websocket sessions on `port`.
+
+    The server is warmed up before accepting sessions, and answers HTTP
+    requests to `HEALTH_PATH` once it does. With more than one worker (0
+    meaning one per core), the plugins are imported once, then that many
+    worker processes are forked to serve the sessions. `max_worker_memory` is
+    the resident memory in bytes above which a worker is replaced.
+
+    Sessions idle for `session_idle_timeout` seconds, or holding more than
+    `session_max_memory` bytes once their caches are shed, are closed. Sessions
+    closed without a shutdown can be resumed for `session_resume_ttl` seconds.
+    Each worker runs its pyflakes checks in `analysis_processes` processes.
+    """
+    if not issubclass(handler_class, PythonLSPServer):
+        raise ValueError("Handler class must be an instance of PythonLSPServer")
+
+    # imports needed only for websockets based server
+    try:
+        import websockets  # pylint: disable=unused-import # noqa: F401
+    except ImportError as e:
+        raise ImportError(
+            "websocket modules missing. Please run pip install 'python-lsp-server[websockets]"
+        ) from e
+
+    # Imported before forking, so that the workers share them
+    _warmup.preload()
+
+    serve_ws = partial(
+        _serve_ws,
+        handler_class,
+        check_parent_process,
+        session_idle_timeout=session_idle_timeout,
+        session_max_memory=session_max_memory,
+        session_resume_ttl=session_resume_ttl,
+        analysis_processes=analysis_processes,
+    )
+    workers = _prefork.worker_count(workers)
+    if workers == 1 and max_worker_memory is None:
+        serve_ws(port=port)
+        return
+
+    sock = _prefork.bind_socket("", port)
+    log.info(
+        "Serving %s on port %s with %d workers", handler_class.__name__, port, workers
+    )
+    supervisor = _prefork.Supervisor(
+        sock, workers, serve_ws, max_worker_memory=max_worker_memory
+    )
+    try:
+        supervisor.serve_forever()
+    finally:
+        sock.close()
+
+
+def _serve_ws(
+    handler_class,
+    check_parent_process,
+    sock=None,
+    port=None,
+    session_idle_timeout=None,
+    session_max_memory=None,
+    session_resume_ttl=None,
+    analysis_processes=0,
+):
+    """Serve websocket sessions on `sock`, or on `port` if no socket is given.
+
+    When serving on a socket given by the supervisor, SIGTERM stops accepting
+    new sessions, and returns once the live ones have ended.
+    """
+    import asyncio
+    import signal
+    from concurrent.futures import ThreadPoolExecutor
+    from http import HTTPStatus
+
+    import websockets
+
+    started = time.perf_counter()
+    _warmup.warm_up(handler_class)
+    # Started after forking, so that each worker has its own processes
+    _pool.configure(analysis_processes)
+    # Websocket of each session, to close it
+    connections = {}
+    session_store = None
+    if session_resume_ttl:
+        session_store = _sessions.SessionStore(ttl=session_resume_ttl)
+
+    with ThreadPoolExecutor(max_workers=10) as tpool:
+
+        async def pylsp_ws(websocket):
+            log.debug("Creating LSP object")
+
+            # creating a partial function and suppling the websocket connection
+            response_handler = partial(send_message, websocket=websocket)
+
+            # Not using default stream reader and writer.
+            # Instead using a consumer based approach to handle processed requests
+            pylsp_handler = handler_class(
+                rx=None,
+                tx=None,
+                consumer=response_handler,
+                check_parent_process=check_parent_process,
+                session_store=session_store,
+            )
+            SESSIONS[pylsp_handler.session_id] = pylsp_handler
+            connections[pylsp_handler.session_id] = websocket
+            _metrics.set_gauge("server.sessions", len(SESSIONS))
+
+            try:
+                async for message in websocket:
+                    try:
+                        log.debug("consuming payload and feeding it to LSP handler")
+                        request = json.loads(message)
+                        loop = asyncio.get_running_loop()
+                        await loop.run_in_executor(
+                            tpool, pylsp_handler.consume, request
+                        )
+                    except Exception as e:
+                        log.exception(
+                            "Failed to process request %s, %s", message, str(e)
+                        )
+            except websockets.ConnectionClosedError as e:
+                # Resumable, e.g. after a drop of the network of the client
+                log.info("Session %s dropped: %s", pylsp_handler.session_id, e)
+            finally:
+                log.debug("Closing session %s", pylsp_handler.session_id)
+                SESSIONS.pop(pylsp_handler.session_id, None)
+                connections.pop(pylsp_handler.session_id, None)
+                _metrics.set_gauge("server.sessions", len(SESSIONS))
+                await asyncio.get_running_loop().run_in_executor(
+                    tpool, pylsp_handler.close
+                )
+
+        def send_message(message, websocket):
+            """Handler to send responses of  processed requests to respective web socket clients"""
+            try:
+                payload = json.dumps(message, ensure_ascii=False)
+                asyncio.run(websocket.send(payload))
+            except Exception as e:
+                log.exception("Failed to write message %s, %s", message, str(e))
+
+        def health_check(connection, request):
+            """Answer the readiness probes of load balancers."""
+            if request.path == HEALTH_PATH:
+                return connection.respond(HTTPStatus.OK, "OK\n")
+            return None
+
+        async def review_sessions():
+            """Shed the caches of idle or oversized sessions, closing them if needed."""
+            loop = asyncio.get_running_loop()
+            while True:
+                await asyncio.sleep(REAP_INTERVAL_S)
+                for session_id, handler in list(SESSIONS.items()):
+                    reason = await loop.run_in_executor(
+                        tpool, handler.review, session_idle_timeout, session_max_memory
+                    )
+                    websocket = connections.get(session_id)
+                    if reason is None or websocket is None:
+                        continue
+                    log.info("Closing session %s: %s", session_id, reason)
+                    _metrics.increment(f"server.sessions_closed.{reason}")
+                    await websocket.close(
+                        SESSION_CLOSE_CODES[reason], f"Session closed: {reason}"
+                    )
+
+        async def run_server():
+            serve = partial(websockets.serve, pylsp_ws, process_request=health_check)
+            if session_idle_timeout is not None or session_max_memory is not None:
+                # Referenced, so that the task is not garbage collected
+                reviewer = asyncio.create_task(review_sessions())  # noqa: F841
+            ready_ms = (time.perf_counter() - started) * 1000
+            log.info("Ready to accept sessions after %.0f ms", ready_ms)
+            if sock is None:
+                async with serve(port=port):
+                    # runs forever
+                    await asyncio.Future()
+                return
+
+            stopping = asyncio.Event()
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+            async with serve(sock=sock) as server:
+                await stopping.wait()
+                log.info("Draining %d sessions", len(SESSIONS))
+                server.close(close_connections=False)
+                while SESSIONS:
+                    await asyncio.sleep(1)
+
+        try:
+            asyncio.run(run_server())
+        finally:
+            _pool.shutdown()
+
+
+class PythonLSPServer(MethodDispatcher):
+    """Implementation of the Microsoft VSCode Language Server Protocol
+    https://github.com/Microsoft/language-server-protocol/blob/master/versions/protocol-1-x.md
+    """
+
+    def __init__(
+        self,
+        rx,
+        tx,
+        check_parent_process=False,
+        consumer=None,
+        *,
+        endpoint_cls=None,
+        session_store=None,
+    ):
+        self.workspace = None
+        self.config = None
+        self.root_uri = None
+        self.watching_thread = None
+        self.workspaces = {}
+        self.uri_workspace_mapper = {}
+        self.session_id = uuid.uuid4().hex
+        self.last_activity = time.monotonic()
+        self._caches_shed = False
+        self.session_store = session_store
+        # Token under which the session is saved when it ends without a shutdown
+        self.session_token = secrets.token_urlsafe(24)
+        # Last settings pushed by the client, and documents restored by resuming
+        self._client_settings = None
+        self._resumed_uris = []
+        self._session_saved = False
+        # Tokens of the running lints by document, cancelled by its next change
+        self._lint_tokens = {}
+        # Last diagnostics by document, with their result id
+        self._diagnostics = {}
+        # Set when the client pulls diagnostics instead of having them pushed
+        self._pull_diagnostics = False
+
+        self._check_parent_process = check_parent_process
+
+        if rx is not None:
+            self._jsonrpc_stream_reader = JsonRpcStreamReader(rx)
+        else:
+            self._jsonrpc_stream_reader = None
+
+        if tx is not None:
+            self._jsonrpc_stream_writer = JsonRpcStreamWriter(tx)
+        else:
+            self._jsonrpc_stream_writer = None
+
+        endpoint_cls = endpoint_cls or _cancel.CancellableEndpoint
+
+        # if consumer is None, it is assumed that the default streams-based approach is being used
+        if consumer is None:
+            self._endpoint = endpoint_cls(
+                self, self._jsonrpc_stream_writer.write, max_workers=MAX_WORKERS
+            )
+        else:
+            self._endpoint = endpoint_cls(self, consumer, max_workers=MAX_WORKERS)
+
+        self._dispatchers = []
+        self._shutdown = False
+
+    def start(self):
+        """Entry point for the server."""
+        self._jsonrpc_stream_reader.listen(self._endpoint.consume)
+
+    def consume(self, message):
+        """Entry point for consumer based server. Alternative to stream listeners."""
+        # assuming message will be JSON
+        self.last_activity = time.monotonic()
+        self._caches_shed = False
+        self._endpoint.consume(message)
+
+    def __getitem__(self, item):
+        """Override getitem to fallback through multiple dispatchers."""
+        if self._shutdown and item != "exit":
+            # exit is the only allowed method during shutdown
+            log.debug("Ignoring non-exit method during shutdown: %s", item)
+            item = "invalid_request_after_shutdown"
+
+        try:
+            return super().__getitem__(item)
+        except KeyError:
+            # Fallback through extra dispatchers
+            for dispatcher in self._dispatchers:
+                try:
+                    return dispatcher[item]
+                except KeyError:
+                    continue
+
+        raise KeyError()
+
+    def m_shutdown(self, **_kwargs):
+        for workspace in self.workspaces.values():
+            workspace.close()
+        self._shutdown = True
+
+    def m_invalid_request_after_shutdown(self, **_kwargs):
+        return {
+            "error": {
+                "code": lsp.ErrorCodes.InvalidRequest,
+                "message": "Requests after shutdown are not valid",
+            }
+        }
+
+    def m_exit(self, **_kwargs):
+        self._endpoint.shutdown()
+        if self._jsonrpc_stream_reader is not None:
+            self._jsonrpc_stream_reader.close()
+        if self._jsonrpc_stream_writer is not None:
+            self._jsonrpc_stream_writer.close()
+
+    def close(self):
+        """Release everything this server holds, e.g. once its client is gone.
+
+        Unless the client shut the session down, it is saved to be resumed.
+        """
+        if not self._shutdown:
+            self._save_session()
+            self.m_shutdown()
+        for workspace in self.workspaces.values():
+            _patch_api.release(workspace._config)
+        self.m_exit()
+
+    def _save_session(self):
+        if self.session_store is None or self.workspace is None:
+            return
+        if self._session_saved:
+            return
+        self._session_saved = True
+        # The text and version of each document are read from one snapshot
+        snapshots = [
+            (document.uri, document.snapshot())
+            for workspace in self.workspaces.values()
+            for document in list(workspace.documents.values())
+            if isinstance(document, Document) and not isinstance(document, Cell)
+        ]
+        documents = [
+            {"uri": uri, "text": snapshot.source, "version": snapshot.version}
+            for uri, snapshot in snapshots
+        ]
+        self.session_store.save(
+            self.session_token,
+            self.root_uri,
+            documents,
+            self._client_settings,
+            [workspace._config for workspace in self.workspaces.values()],
+        )
+
+    def _resume_session(self, token):
+        """Restore the documents and settings of the session saved as `token`."""
+        if self.session_store is None or not token:
+            return False
+        for session in list(SESSIONS.values()):
+            if session is not self and session.session_token == token:
+                # Its connection dropped without the server noticing yet
+                session._save_session()
+        snapshot = self.session_store.take(token)
+        if snapshot is None:
+            return False
+        if snapshot["root_uri"] != self.root_uri:
+            log.info("Not resuming session %s of another root", token)
+            self.session_store.release(token)
+            return False
+
+        if snapshot["settings"] is not None:
+            self.m_workspace__did_change_configuration(snapshot["settings"])
+        for document in snapshot["documents"]:
+            workspace = self._match_uri_to_workspace(document["uri"])
+            workspace.put_document(
+                document["uri"], document["text"], version=document["version"]
+            )
+            self._hook("pylsp_document_did_open", document["uri"])
+            self._resumed_uris.append(document["uri"])
+        # Held for the restored settings before the artifacts kept warm for the
+        # snapshot are released, so that they stay built
+        for workspace in self.workspaces.values():
+            _patch_api.hold(workspace._config)
+        self.session_store.release(token)
+        log.info("Resumed session %s with %d documents", token, len(self._resumed_uris))
+        return True
+
+    def review(self, idle_timeout=None, max_memory=None):
+        """Shed the caches of the session if it is idle or holds too much.
+
+        Returns why the session should be closed, "idle" or "memory", or None.
+        """
+        idle = time.monotonic() - self.last_activity
+        if idle_timeout is not None:
+            if idle >= idle_timeout:
+                return "idle"
+            if idle >= idle_timeout * IDLE_SHED_FRACTION:
+                self.shed_caches()
+        if max_memory is not None and self.memory_estimate() > max_memory:
+            self.shed_caches()
+            if self.memory_estimate() > max_memory:
+                return "memory"
+        return None
+
+    def shed_caches(self):
+        """Drop the caches of the session, until its next message."""
+        if self._caches_shed:
+            return
+        for workspace in list(self.workspaces.values()):
+            workspace.shed_caches()
+        self._caches_shed = True
+        _metrics.increment("server.sessions_shed")
+
+    def memory_estimate(self):
+        return sum(
+            workspace.memory_estimate() for workspace in list(self.workspaces.values())
+        )
+
+    def m_pylsp__metrics(self, **_kwargs):
+        """Return the metrics recorded by the server and its plugins."""
+        return _metrics.snapshot()
+
+    def _match_uri_to_workspace(self, uri):
+        workspace_uri = _utils.match_uri_to_workspace(uri, self.workspaces)
+        return self.workspaces.get(workspace_uri, self.workspace)
+
+    def _hook(self, hook_name, doc_uri=None, workspace=None, **kwargs):
+        """Calls hook_name and returns a list of results from all registered handlers"""
+        _cancel.check()
+        if workspace is None:
+            workspace = self._match_uri_to_workspace(doc_uri)
+        doc = workspace.get_document(doc_uri) if doc_uri else None
+        hook_handlers = self.config.plugin_manager.subset_hook_caller(
+            hook_name, self.config.disabled_plugins
+        )
+        if isinstance(doc, Document) and hook_name in JEDI_HOOKS:
+            # Jedi finds its tree of the document by path, in every session
+            with doc.jedi_inference():
+                return hook_handlers(
+                    config=self.config, workspace=workspace, document=doc, **kwargs
+                )
+        return hook_handlers(
+            config=self.config, workspace=workspace, document=doc, **kwargs
+        )
+
+    def capabilities(self):
+        server_capabilities = {
+            "codeActionProvider": True,
+            "codeLensProvider": {
+                "resolveProvider": False,  # We may need to make this configurable
+            },
+            "completionProvider": {
+                "resolveProvider": True,  # We could know everything ahead of time, but this takes time to transfer
+                "triggerCharacters": ["."],
+            },
+            "documentFormattingProvider": True,
+            "documentHighlightProvider": True,
+            "documentRangeFormattingProvider": True,
+            "documentSymbolProvider": True,
+            "definitionProvider": True,
+            "diagnosticProvider": {
+                "interFileDependencies": False,
+                "workspaceDiagnostics": False,
+            },
+            "executeCommandProvider": {
+                "commands": flatten(self._hook("pylsp_commands"))
+            },
+            "hoverProvider": True,
+            "referencesProvider": True,
+            "renameProvider": True,
+            "foldingRangeProvider": True,
+            "signatureHelpProvider": {"triggerCharacters": ["(", ",", "="]},
+            "textDocumentSync": {
+                "change": lsp.TextDocumentSyncKind.INCREMENTAL,
+                "save": {
+                    "includeText": True,
+                },
+                "openClose": True,
+            },
+            "notebookDocumentSync": {
+                "notebookSelector": [{"cells": [{"language": "python"}]}]
+            },
+            "workspace": {
+                "workspaceFolders": {"supported": True, "changeNotifications": True}
+            },
+            "experimental": merge(self._hook("pylsp_experimental_capabilities")),
+        }
+        log.info("Server capabilities: %s", server_capabilities)
+        return server_capabilities
+
+    def m_initialize(
+        self,
+        processId=None,
+        rootUri=None,
+        rootPath=None,
+        initializationOptions=None,
+        workspaceFolders=None,
+        **_kwargs,
+    ):
+        log.debug(
+            "Language server initialized with %s %s %s %s",
+            processId,
+            rootUri,
+            rootPath,
+            initializationOptions,
+        )
+        if rootUri is None:
+            rootUri = uris.from_fs_path(rootPath) if rootPath is not None else ""
+
+        self.workspaces.pop(self.root_uri, None)
+        self.root_uri = rootUri
+        self.config = config.Config(
+            rootUri,
+            initializationOptions or {},
+            processId,
+            _kwargs.get("capabilities", {}),
+        )
+        self.workspace = Workspace(rootUri, self._endpoint, self.config)
+        self.workspaces[rootUri] = self.workspace
+        self._pull_diagnostics = (
+            "diagnostic" in self.config.capabilities.get("textDocument", {})
+        )
+        if workspaceFolders:
+            for folder in workspaceFolders:
+                uri = folder["uri"]
+                if uri == rootUri:
+                    # Already created
+                    continue
+                workspace_config = config.Config(
+                    uri,
+                    self.config._init_opts,
+                    self.config._process_id,
+                    self.config._capabilities,
+                )
+                workspace_config.update(self.config._settings)
+                self.workspaces[uri] = Workspace(uri, self._endpoint, workspace_config)
+
+        self._dispatchers = self._hook("pylsp_dispatchers")
+        self._hook("pylsp_initialize")
+        resumed = self._resume_session(
+            (initializationOptions or {}).get("resumeToken")
+        )
+
+        if (
+            self._check_parent_process
+            and processId is not None
+            and self.watching_thread is None
+        ):
+
+            def watch_parent_process(pid):
+                # exit when the given pid is not alive
+                if not _utils.is_process_alive(pid):
+                    log.info("parent process %s is not alive, exiting!", pid)
+                    self.m_exit()
+                else:
+                    threading.Timer(
+                        PARENT_PROCESS_WATCH_INTERVAL, watch_parent_process, args=[pid]
+                    ).start()
+
+            self.watching_thread = threading.Thread(
+                target=watch_parent_process, args=(processId,)
+            )
+            self.watching_thread.daemon = True
+            self.watching_thread.start()
+        # Get our capabilities
+        result = {
+            "capabilities": self.capabilities(),
+            "serverInfo": {
+                "name": "pylsp",
+                "version": __version__,
+            },
+        }
+        if self.session_store is not None:
+            result["sessionToken"] = self.session_token
+            result["resumed"] = resumed
+        return result
+
+    def m_initialized(self, **_kwargs):
+        self._hook("pylsp_initialized")
+        # Diagnostics are not sent before the client knows the session resumed
+        for doc_uri in self._resumed_uris:
+            self.lint(doc_uri, is_saved=True)
+        self._resumed_uris = []
+
+    def code_actions(self, doc_uri: str, range: Dict, context: Dict):
+        return flatten(
+            self._hook("pylsp_code_actions", doc_uri, range=range, context=context)
+        )
+
+    def code_lens(self, doc_uri):
+        return flatten(self._hook("pylsp_code_lens", doc_uri))
+
+    def completions(self, doc_uri, position):
+        workspace = self._match_uri_to_workspace(doc_uri)
+        document = workspace.get_document(doc_uri)
+        ignored_names = None
+        if isinstance(document, Cell):
+            # We need to get the ignored names from the whole notebook document
+            notebook_document = workspace.get_maybe_document(document.notebook_uri)
+            ignored_names = notebook_document.jedi_names(doc_uri)
+        completions = self._hook(
+            "pylsp_completions", doc_uri, position=position, ignored_names=ignored_names
+        )
+        # Set by plugins that answered without waiting for their full results
+        is_incomplete = document.shared_data.pop("COMPLETIONS_INCOMPLETE", False)
+        return {"isIncomplete": is_incomplete, "items": flatten(completions)}
+
+    def completion_item_resolve(self, completion_item):
+        doc_uri = completion_item.get("data", {}).get("doc_uri", None)
+        return self._hook(
+            "pylsp_completion_item_resolve", doc_uri, completion_item=completion_item
+        )
+
+    def definitions(self, doc_uri, position):
+        return flatten(self._hook("pylsp_definitions", doc_uri, position=position))
+
+    def document_symbols(self, doc_uri):
+        return flatten(self._hook("pylsp_document_symbols", doc_uri))
+
+    def document_did_save(self, doc_uri):
+        return self._hook("pylsp_document_did_save", doc_uri)
+
+    def execute_command(self, command, arguments):
+        return self._hook("pylsp_execute_command", command=command, arguments=arguments)
+
+    def format_document(self, doc_uri, options):
+        return lambda: self._hook("pylsp_format_document", doc_uri, options=options)
+
+    def format_range(self, doc_uri, range, options):
+        return self._hook("pylsp_format_range", doc_uri, range=range, options=options)
+
+    def highlight(self, doc_uri, position):
+        return (
+            flatten(self._hook("pylsp_document_highlight", doc_uri, position=position))
+            or None
+        )
+
+    def hover(self, doc_uri, position):
+        return self._hook("pylsp_hover", doc_uri, position=position) or {"contents": ""}
+
+    def lint(self, doc_uri, is_saved):
+        if self._pull_diagnostics:
+            # The client pulls the diagnostics of the documents it shows
+            return
+        # The timers of the debounce are shared by all the sessions, which open
+        # documents of the same uri
+        self._debounced_lint((self, doc_uri), is_saved)
+
+    @_utils.debounce(LINT_DEBOUNCE_S, keyed_by="lint_key")
+    def _debounced_lint(self, lint_key, is_saved):
+        _server, doc_uri = lint_key
+        token = _cancel.Token()
+        self._cancel_lint(doc_uri)
+        self._lint_tokens[doc_uri] = token
+        _scheduler.SCHEDULER.submit(
+            "diagnostics", self._run_lint, doc_uri, is_saved, token
+        )
+
+    def _run_lint(self, doc_uri, is_saved, token):
+        try:
+            with _cancel.use(token):
+                token.check()
+                # Since we're debounced, the document may no longer be open
+                workspace = self._match_uri_to_workspace(doc_uri)
+                document_object = workspace.documents.get(doc_uri, None)
+                if isinstance(document_object, Document):
+                    self._lint_text_document(doc_uri, workspace, is_saved=is_saved)
+                elif isinstance(document_object, Notebook):
+                    self._lint_notebook_document(document_object, workspace)
+        except _cancel.RequestCancelled:
+            log.debug("Cancelled the outdated lint of %s", doc_uri)
+        except Exception:  # pylint: disable=broad-except
+            log.exception("Failed to lint %s", doc_uri)
+        finally:
+            if self._lint_tokens.get(doc_uri) is token:
+                del self._lint_tokens[doc_uri]
+
+    def _cancel_lint(self, doc_uri):
+        token = self._lint_tokens.pop(doc_uri, None)
+        if token is not None:
+            token.cancel()
+
+    def _lint_text_document(self, doc_uri, workspace, is_saved):
+        result_id = self._diagnostics_result_id(workspace.get_document(doc_uri))
+        diagnostics = flatten(self._hook("pylsp_lint", doc_uri, is_saved=is_saved))
+        # Plugins ignoring the token still must not publish outdated diagnostics
+        _cancel.check()
+        self._diagnostics[doc_uri] = (result_id, diagnostics)
+        workspace.publish_diagnostics(doc_uri, diagnostics)
+
+    def pull_diagnostics(self, doc_uri, previous_result_id=None):
+        """Answer a diagnostic pull, without linting if nothing changed.
+
+        The result id is derived from the document version and the lint
+        settings, which are all that the lint plugins depend on.
+        """
+        workspace = self._match_uri_to_workspace(doc_uri)
+        document = workspace.get_maybe_document(doc_uri)
+        if not isinstance(document, Document):
+            return {"kind": "full", "items": []}
+
+        result_id = self._diagnostics_result_id(document)
+        if result_id == previous_result_id:
+            _metrics.increment("diagnostics.pull_unchanged")
+            return {"kind": "unchanged", "resultId": result_id}
+        cached = self._diagnostics.get(doc_uri)
+        if cached is not None and cached[0] == result_id:
+            _metrics.increment("diagnostics.pull_cached")
+            return {"kind": "full", "resultId": result_id, "items": cached[1]}
+
+        diagnostics = flatten(self._hook("pylsp_lint", doc_uri, is_saved=False))
+        if self._diagnostics_result_id(document) != result_id:
+            return {
+                "error": {
+                    "code": lsp.ErrorCodes.ServerCancelled,
+                    "message": "The document changed while linting",
+                    "data": {"retriggerRequest": True},
+                }
+            }
+        self._diagnostics[doc_uri] = (result_id, diagnostics)
+        _metrics.increment("diagnostics.pull_linted")
+        return {"kind": "full", "resultId": result_id, "items": diagnostics}
+
+    @staticmethod
+    def _diagnostics_result_id(document):
+        snapshot = document.snapshot()
+        version = snapshot.version
+        if version is None:
+            version = content_key("source", snapshot.source)[1][:16]
+        config = document._config
+        settings = config.settings()
+        cached = _LINT_CONFIG_KEYS.get(config)
+        if cached is None or cached[0] is not settings:
+            # Hashed once per change of the settings, which are cached until then
+            plugins = settings.get("plugins") or {}
+            lint_config = {
+                "plugins": {name: plugins.get(name) for name in _lint_plugins(config)},
+                "configurationSources": settings.get("configurationSources"),
+                "patchApi": _patch_api.api_index_key(config),
+            }
+            cached = _LINT_CONFIG_KEYS[config] = (
+                settings,
+                content_key("lint", lint_config)[1][:16],
+            )
+        return f"{version}:{cached[1]}"
+
+    def _lint_notebook_document(self, notebook_document, workspace):
+        """
+        Lint a notebook document.
+
+        This is a bit more complicated than linting a text document, because we need to
+        send the entire notebook document to the pylsp_lint hook, but we need to send
+        the diagnostics back to the client on a per-cell basis.
+        """
+
+        # First, we create a temp TextDocument that represents the whole notebook
+        # contents. We'll use this to send to the pylsp_lint hook.
+        random_uri = str(uuid.uuid4())
+
+        # cell_list helps us map the diagnostics back to the correct cell later.
+        cell_list: List[Dict[str, Any]] = []
+
+        offset = 0
+        total_source = ""
+        for cell in notebook_document.cells:
+            cell_uri = cell["document"]
+            cell_document = workspace.get_cell_document(cell_uri)
+
+            num_lines = cell_document.line_count
+
+            data = {
+                "uri": cell_uri,
+                "line_start": offset,
+                "line_end": offset + num_lines - 1,
+                "source": cell_document.source,
+            }
+
+            cell_list.append(data)
+            if offset == 0:
+                total_source = cell_document.source
+            else:
+                total_source += "\n" + cell_document.source
+
+            offset += num_lines
+
+        workspace.put_document(random_uri, total_source)
+
+        try:
+            document_diagnostics = flatten(
+                self._hook("pylsp_lint", random_uri, is_saved=True)
+            )
+
+            # Now we need to map the diagnostics back to the correct cell and publish them.
+            # Note: this is O(n*m) in the number of cells and diagnostics, respectively.
+            for cell in cell_list:
+                cell_diagnostics = []
+                for diagnostic in document_diagnostics:
+                    start_line = diagnostic["range"]["start"]["line"]
+                    end_line = diagnostic["range"]["end"]["line"]
+
+                    if start_line > cell["line_end"] or end_line < cell["line_start"]:
+                        continue
+                    diagnostic["range"]["start"]["line"] = (
+                        start_line - cell["line_start"]
+                    )
+                    diagnostic["range"]["end"]["line"] = end_line - cell["line_start"]
+                    cell_diagnostics.append(diagnostic)
+
+                workspace.publish_diagnostics(cell["uri"], cell_diagnostics)
+        finally:
+            workspace.rm_document(random_uri)
+
+    def references(self, doc_uri, position, exclude_declaration):
+        return flatten(
+            self._hook(
+                "pylsp_references",
+                doc_uri,
+                position=position,
+                exclude_declaration=exclude_declaration,
+            )
+        )
+
+    def rename(self, doc_uri, position, new_name):
+        return self._hook("pylsp_rename", doc_uri, position=position, new_name=new_name)
+
+    def signature_help(self, doc_uri, position):
+        return self._hook("pylsp_signature_help", doc_uri, position=position)
+
+    def folding(self, doc_uri):
+        return flatten(self._hook("pylsp_folding_range", doc_uri))
+
+    def m_completion_item__resolve(self, **completionItem):
+        return self.completion_item_resolve(completionItem)
+
+    def m_notebook_document__did_open(
+        self, notebookDocument=None, cellTextDocuments=None, **_kwargs
+    ):
+        workspace = self._match_uri_to_workspace(notebookDocument["uri"])
+        workspace.put_notebook_document(
+            notebookDocument["uri"],
+            notebookDocument["notebookType"],
+            cells=notebookDocument["cells"],
+            version=notebookDocument.get("version"),
+            metadata=notebookDocument.get("metadata"),
+        )
+        for cell in cellTextDocuments or []:
+            workspace.put_cell_document(
+                cell["uri"],
+                notebookDocument["uri"],
+                cell["languageId"],
+                cell["text"],
+                version=cell.get("version"),
+            )
+        self.lint(notebookDocument["uri"], is_saved=True)
+
+    def m_notebook_document__did_close(
+        self, notebookDocument=None, cellTextDocuments=None, **_kwargs
+    ):
+        workspace = self._match_uri_to_workspace(notebookDocument["uri"])
+        for cell in cellTextDocuments or []:
+            workspace.publish_diagnostics(cell["uri"], [])
+            workspace.rm_document(cell["uri"])
+        workspace.rm_document(notebookDocument["uri"])
+
+    def m_notebook_document__did_change(
+        self, notebookDocument=None, change=None, **_kwargs
+    ):
+        """
+        Changes to the notebook document.
+
+        This could be one of the following:
+        1. Notebook metadata changed
+        2. Cell(s) added
+        3. Cell(s) deleted
+        4. Cell(s) data changed
+            4.1 Cell metadata changed
+            4.2 Cell source changed
+        """
+        workspace = self._match_uri_to_workspace(notebookDocument["uri"])
+
+        if change.get("metadata"):
+            # Case 1
+            workspace.update_notebook_metadata(
+                notebookDocument["uri"], change.get("metadata")
+            )
+
+        cells = change.get("cells")
+        if cells:
+            # Change to cells
+            structure = cells.get("structure")
+            if structure:
+                # Case 2 or 3
+                notebook_cell_array_change = structure["array"]
+                start = notebook_cell_array_change["start"]
+                cell_delete_count = notebook_cell_array_change["deleteCount"]
+                if cell_delete_count == 0:
+                    # Case 2
+                    # Cell documents
+                    for cell_document in structure["didOpen"]:
+                        workspace.put_cell_document(
+                            cell_document["uri"],
+                            notebookDocument["uri"],
+                            cell_document["languageId"],
+                            cell_document["text"],
+                            cell_document.get("version"),
+                        )
+                    # Cell metadata which is added to Notebook
+                    workspace.add_notebook_cells(
+                        notebookDocument["uri"],
+                        notebook_cell_array_change["cells"],
+                        start,
+                    )
+                else:
+                    # Case 3
+                    # Cell documents
+                    for cell_document in structure["didClose"]:
+                        workspace.rm_document(cell_document["uri"])
+                        workspace.publish_diagnostics(cell_document["uri"], [])
+                    # Cell metadata which is removed from Notebook
+                    workspace.remove_notebook_cells(
+                        notebookDocument["uri"], start, cell_delete_count
+                    )
+
+            data = cells.get("data")
+            if data:
+                # Case 4.1
+                for cell in data:
+                    # update NotebookDocument.cells properties
+                    pass
+
+            text_content = cells.get("textContent")
+            if text_content:
+                # Case 4.2
+                for cell in text_content:
+                    cell_uri = cell["document"]["uri"]
+                    # Even though the protocol says that `changes` is an array, we assume that it's always a single
+                    # element array that contains the last change to the cell source.
+                    workspace.update_document(cell_uri, cell["changes"][0])
+        self.lint(notebookDocument["uri"], is_saved=True)
+
+    def m_text_document__did_close(self, textDocument=None, **_kwargs):
+        self._cancel_lint(textDocument["uri"])
+        self._diagnostics.pop(textDocument["uri"], None)
+        workspace = self._match_uri_to_workspace(textDocument["uri"])
+        workspace.publish_diagnostics(textDocument["uri"], [])
+        workspace.rm_document(textDocument["uri"])
+
+    def m_text_document__did_open(self, textDocument=None, **_kwargs):
+        workspace = self._match_uri_to_workspace(textDocument["uri"])
+        workspace.put_document(
+            textDocument["uri"],
+            textDocument["text"],
+            version=textDocument.get("version"),
+        )
+        self._hook("pylsp_document_did_open", textDocument["uri"])
+        self.lint(textDocument["uri"], is_saved=True)
+
+    def m_text_document__did_change(
+        self, contentChanges=None, textDocument=None, **_kwargs
+    ):
+        self._cancel_lint(textDocument["uri"])
+        workspace = self._match_uri_to_workspace(textDocument["uri"])
+        workspace.update_document_changes(
+            textDocument["uri"], contentChanges, version=textDocument.get("version")
+        )
+        self._hook(
+            "pylsp_document_did_change", textDocument["uri"], changes=contentChanges
+        )
+        self.lint(textDocument["uri"], is_saved=False)
+
+    def m_text_document__did_save(self, textDocument=None, **_kwargs):
+        self.lint(textDocument["uri"], is_saved=True)
+        self.document_did_save(textDocument["uri"])
+
+    def m_text_document__code_action(
+        self, textDocument=None, range=None, context=None, **_kwargs
+    ):
+        return self.code_actions(textDocument["uri"], range, context)
+
+    def m_text_document__code_lens(self, textDocument=None, **_kwargs):
+        return self.code_lens(textDocument["uri"])
+
+    def _cell_document__completion(self, cellDocument, position=None, **_kwargs):
+        workspace = self._match_uri_to_workspace(cellDocument.notebook_uri)
+        notebookDocument = workspace.get_maybe_document(cellDocument.notebook_uri)
+        if notebookDocument is None:
+            raise ValueError("Invalid notebook document")
+
+        cell_data = notebookDocument.cell_data()
+
+        # Concatenate all cells to be a single temporary document
+        total_source = "\n".join(data["source"] for data in cell_data.values())
+        with workspace.temp_document(total_source) as temp_uri:
+            # update position to be the position in the temp document
+            if position is not None:
+                position["line"] += cell_data[cellDocument.uri]["line_start"]
+
+            completions = self.completions(temp_uri, position)
+
+            # Translate temp_uri locations to cell document locations
+            for item in completions.get("items", []):
+                if item.get("data", {}).get("doc_uri") == temp_uri:
+                    item["data"]["doc_uri"] = cellDocument.uri
+
+            return completions
+
+    def m_text_document__completion(self, textDocument=None, position=None, **_kwargs):
+        # textDocument here is just a dict with a uri
+        workspace = self._match_uri_to_workspace(textDocument["uri"])
+        document = workspace.get_document(textDocument["uri"])
+        if isinstance(document, Cell):
+            return self._cell_document__completion(document, position, **_kwargs)
+        return self.completions(textDocument["uri"], position)
+
+    def _cell_document__definition(self, cellDocument, position=None, **_kwargs):
+        workspace = self._match_uri_to_workspace(cellDocument.notebook_uri)
+        notebookDocument = workspace.get_maybe_document(cellDocument.notebook_uri)
+        if notebookDocument is None:
+            raise ValueError("Invalid notebook document")
+
+        cell_data = notebookDocument.cell_data()
+
+        # Concatenate all cells to be a single temporary document
+        total_source = "\n".join(data["source"] for data in cell_data.values())
+        with workspace.temp_document(total_source) as temp_uri:
+            # update position to be the position in the temp document
+            if position is not None:
+                position["line"] += cell_data[cellDocument.uri]["line_start"]
+
+            definitions = self.definitions(temp_uri, position)
+
+            # Translate temp_uri locations to cell document locations
+            for definition in definitions:
+                if definition["uri"] == temp_uri:
+                    # Find the cell the start line is in and adjust the uri and line numbers
+                    for cell_uri, data in cell_data.items():
+                        if (
+                            data["line_start"]
+                            <= definition["range"]["start"]["line"]
+                            <= data["line_end"]
+                        ):
+                            definition["uri"] = cell_uri
+                            definition["range"]["start"]["line"] -= data["line_start"]
+                            definition["range"]["end"]["line"] -= data["line_start"]
+                            break
+
+            return definitions
+
+    def m_text_document__definition(self, textDocument=None, position=None, **_kwargs):
+        # textDocument here is just a dict with a uri
+        workspace = self._match_uri_to_workspace(textDocument["uri"])
+        document = workspace.get_document(textDocument["uri"])
+        if isinstance(document, Cell):
+            return self._cell_document__definition(document, position, **_kwargs)
+        return self.definitions(textDocument["uri"], position)
+
+    def m_text_document__diagnostic(
+        self, textDocument=None, previousResultId=None, **_kwargs
+    ):
+        return self.pull_diagnostics(textDocument["uri"], previousResultId)
+
+    def m_text_document__document_highlight(
+        self, textDocument=None, position=None, **_kwargs
+    ):
+        return self.highlight(textDocument["uri"], position)
+
+    def m_text_document__hover(self, textDocument=None, position=None, **_kwargs):
+        return self.hover(textDocument["uri"], position)
+
+    def m_text_document__document_symbol(self, textDocument=None, **_kwargs):
+        return self.document_symbols(textDocument["uri"])
+
+    def m_text_document__formatting(self, textDocument=None, options=None, **_kwargs):
+        return self.format_document(textDocument["uri"], options)
+
+    def m_text_document__rename(
+        self, textDocument=None, position=None, newName=None, **_kwargs
+    ):
+        return self.rename(textDocument["uri"], position, newName)
+
+    def m_text_document__folding_range(self, textDocument=None, **_kwargs):
+        return self.folding(textDocument["uri"])
+
+    def m_text_document__range_formatting(
+        self, textDocument=None, range=None, options=None, **_kwargs
+    ):
+        return self.format_range(textDocument["uri"], range, options)
+
+    def m_text_document__references(
+        self, textDocument=None, position=None, context=None, **_kwargs
+    ):
+        exclude_declaration = not context["includeDeclaration"]
+        return self.references(textDocument["uri"], position, exclude_declaration)
+
+    def m_text_document__signature_help(
+        self, textDocument=None, position=None, **_kwargs
+    ):
+        return self.signature_help(textDocument["uri"], position)
+
+    def m_workspace__did_change_configuration(self, settings=None):
+        self._client_settings = settings
+        refresh = False
+        # The root workspace shares the config of the server, which is updated
+        # with it, as a whole, so that the changed keys are diffed once
+        for workspace in self.workspaces.values():
+            changed_keys = workspace.update_config(settings)
+            if not changed_keys:
+                continue
+            self._hook(
+                "pylsp_workspace_configuration_changed",
+                workspace=workspace,
+                changed_keys=changed_keys,
+            )
+            if not changed_keys & _lint_settings(workspace._config):
+                continue
+            refresh = True
+            for doc_uri in workspace.documents:
+                self.lint(doc_uri, is_saved=False)
+        if refresh and self._pull_diagnostics and self._diagnostics_refresh_support():
+            # Pulled diagnostics depend on the lint settings too
+            self._endpoint.request("workspace/diagnostic/refresh")
+
+    def _diagnostics_refresh_support(self):
+        workspace_capabilities = self.config.capabilities.get("workspace", {})
+        diagnostics = workspace_capabilities.get("diagnostics", {})
+        return diagnostics.get("refreshSupport", False)
+
+    def m_workspace__did_change_workspace_folders(self, event=None, **_kwargs):
+        if event is None:
+            return
+        added = event.get("added", [])
+        removed = event.get("removed", [])
+
+        for removed_info in removed:
+            if "uri" in removed_info:
+                removed_uri = removed_info["uri"]
+                self.workspaces.pop(removed_uri, None)
+
+        for added_info in added:
+            if "uri" in added_info:
+                added_uri = added_info["uri"]
+                workspace_config = config.Config(
+                    added_uri,
+                    self.config._init_opts,
+                    self.config._process_id,
+                    self.config._capabilities,
+                )
+                workspace_config.update(self.config._settings)
+                self.workspaces[added_uri] = Workspace(
+                    added_uri, self._endpoint, workspace_config
+                )
+
+        root_workspace_removed = any(
+            removed_info["uri"] == self.root_uri for removed_info in removed
+        )
+        workspace_added = len(added) > 0 and "uri" in added[0]
+        if root_workspace_removed and workspace_added:
+            added_uri = added[0]["uri"]
+            self.root_uri = added_uri
+            new_root_workspace = self.workspaces[added_uri]
+            self.config = new_root_workspace._config
+            self.workspace = new_root_workspace
+        elif root_workspace_removed:
+            # NOTE: Removing the root workspace can only happen when the server
+            # is closed, thus the else condition of this if can never happen.
+            if self.workspaces:
+                log.debug("Root workspace deleted!")
+                available_workspaces = sorted(self.workspaces)
+                first_workspace = available_workspaces[0]
+                new_root_workspace = self.workspaces[first_workspace]
+                self.root_uri = first_workspace
+                self.config = new_root_workspace._config
+                self.workspace = new_root_workspace
+
+        # Migrate documents that are on the root workspace and have a better
+        # match now
+        doc_uris = list(self.workspace._docs.keys())
+        for uri in doc_uris:
+            doc = self.workspace._docs.pop(uri)
+            new_workspace = self._match_uri_to_workspace(uri)
+            new_workspace._docs[uri] = doc
+
+    def m_workspace__did_change_watched_files(self, changes=None, **_kwargs):
+        changed_py_files = set()
+        config_changed = False
+        for d in changes or []:
+            if d["uri"].endswith(PYTHON_FILE_EXTENSIONS):
+                changed_py_files.add(d["uri"])
+            elif d["uri"].endswith(CONFIG_FILEs):
+                config_changed = True
+
+        if config_changed:
+            self.config.settings.cache_clear()
+        elif not changed_py_files:
+            # Only externally changed python files and lint configs may result in changed diagnostics.
+            return
+
+        for workspace in self.workspaces.values():
+            for doc_uri in workspace.documents:
+                # Changes in doc_uri are already handled by m_text_document__did_save
+                if doc_uri not in changed_py_files:
+                    self.lint(doc_uri, is_saved=False)
+
+    def m_workspace__execute_command(self, command=None, arguments=None):
+        return self.execute_command(command, arguments)
+
+
+def _lint_plugins(config):
+    """Return the names of the plugins implementing ``pylsp_lint``."""
+    hook = config.plugin_manager.hook.pylsp_lint
+    return sorted(impl.plugin_name for impl in hook.get_hookimpls())
+
+
+def _lint_settings(config):
+    """Return the settings keys the diagnostics depend on."""
+    return LINT_SETTINGS | {f"plugins.{name}" for name in _lint_plugins(config)}
+
+
+def flatten(list_of_lists):
+    return [item for lst in list_of_lists for item in lst]
+
+
+def merge(list_of_dicts):
+    return {k: v for dictionary in list_of_dicts for k, v in dictionary.items()}
@@ -0,0 +1,58 @@
+# Copyright 2021- Python Language Server Contributors.
+
+import ast
+
+from pyflakes import checker
+
+from pylsp.plugins import _flakes
+from pylsp.plugins.pyflakes_lint import lint_source
+
+
+def _messages(source, cache):
+    w = _flakes.IncrementalChecker(
+        ast.parse(source), source.splitlines(True), cache=cache, filename="t.py"
+    )
+    return sorted(_describe(m) for m in w.messages)
+
+
+def _full_messages(source):
+    w = checker.Checker(ast.parse(source), filename="t.py")
+    return sorted(_describe(m) for m in w.messages)
+
+
+def _describe(message):
+    return (type(message).__name__, message.lineno, message.col, message.message_args)
+
+
+def test_builtin_used_before_local_assignment():
+    source = "def f():\n    print(len)\n    len = 3\n"
+    diagnostics = lint_source(source, "t.py", [])
+    assert [d["range"]["start"]["line"] for d in diagnostics] == [1, 2]
+    assert _messages(source, _flakes.LRUCache(16)) == _full_messages(source)
+
+
+def test_replayed_messages_match_a_full_pass():
+    cache = _flakes.LRUCache(16)
+    sources = [
+        "import os\n\ndef f():\n    print(len)\n    len = 3\n",
+        "import os\n\n\ndef f():\n    print(len)\n    len = 3\n",
+        "x = 1\n\ndef f():\n    print(x)\n    x = 2\n",
+        "\nx = 1\n\ndef f():\n    print(x)\n    x = 2\n",
+        "def f():\n    import os\n    import os\n",
+        "\n\ndef f():\n    import os\n    import os\n",
+    ]
+    for source in sources:
+        assert _messages(source, cache) == _full_messages(source)
+
+
+def test_package_init_is_cached_apart():
+    cache = _flakes.LRUCache(16)
+    source = "def f():\n    return __path__\n"
+    for filename in ("__init__.py", "t.py", "__init__.py"):
+        w = _flakes.IncrementalChecker(
+            ast.parse(source), source.splitlines(True), cache=cache, filename=filename
+        )
+        full = checker.Checker(ast.parse(source), filename=filename)
+        assert sorted(map(_describe, w.messages)) == sorted(
+            map(_describe, full.messages)
+        )
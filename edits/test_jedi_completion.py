@@ -0,0 +1,47 @@
+# Copyright 2021- Python Language Server Contributors.
+
+import sys
+from types import SimpleNamespace
+
+import parso
+
+from pylsp.plugins import jedi_completion
+from pylsp.plugins.jedi_completion import _in_import_context, is_exception_class
+
+
+def _at_end(source):
+    lines = source.split("\n")
+    return {"line": len(lines) - 1, "character": len(lines[-1])}
+
+
+def test_import_after_multi_line_statement():
+    for source in (
+        "x = [1,\n  2]; from os import p",
+        "x = [1,\n  2]; from os import (a,\n  p",
+        "x = [1,\n  2]; import o",
+        "x = [1,\n  2]\nfrom os import ",
+    ):
+        assert _in_import_context(parso.parse(source), _at_end(source)), source
+
+
+def test_statement_after_multi_line_statement():
+    for source in (
+        "x = [1,\n  2]; y = p",
+        "x = [1,\n  2]; print('import' + p",
+        "from os import path\nx = [1,\n  2]; f(p",
+    ):
+        assert not _in_import_context(parso.parse(source), _at_end(source)), source
+
+
+def test_exception_class_names_of_environment(monkeypatch):
+    monkeypatch.setattr(jedi_completion, "_EXCEPTION_CLASS_NAMES", {})
+    names = jedi_completion._exception_class_names(
+        "env", SimpleNamespace(executable=sys.executable)
+    )
+    assert is_exception_class("KeyError", names)
+    assert is_exception_class("BaseExceptionGroup", names)
+    # Exceptions the server happens to have imported are not included
+    assert not is_exception_class("RequestCancelled", names)
+    assert not is_exception_class("Empty", names)
+    other = SimpleNamespace(executable="/nonexistent/python")
+    assert jedi_completion._exception_class_names("env", other) is names
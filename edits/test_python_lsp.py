@@ -0,0 +1,111 @@
+# Copyright 2021- Python Language Server Contributors.
+
+import os
+import time
+
+from pylsp import _patch_api, _sessions, uris
+from pylsp._shared import SHARED
+from pylsp.python_lsp import PythonLSPServer
+
+API_DATA = {"move": {"description": "Move", "parameters": [{"name": "steps"}]}}
+
+
+def _server(tmp_path, source="import os\n", consumer=None, **kwargs):
+    consumer = consumer or (lambda _message: None)
+    server = PythonLSPServer(None, None, consumer=consumer, **kwargs)
+    server.m_initialize(processId=None, rootUri=uris.from_fs_path(str(tmp_path)))
+    uri = uris.from_fs_path(os.path.join(str(tmp_path), "index.py"))
+    server.workspace.put_document(uri, source, version=1)
+    return server, server.workspace.get_document(uri)
+
+
+def test_result_id_only_depends_on_lint_settings(tmp_path):
+    server, document = _server(tmp_path)
+    try:
+        settings = {"plugins": {"jedi_completion": {"deadline": 0.2}}}
+        server.m_workspace__did_change_configuration(settings=settings)
+        result_id = server._diagnostics_result_id(document)
+
+        settings = {"plugins": {"jedi_completion": {"deadline": 1}}}
+        server.m_workspace__did_change_configuration(settings=settings)
+        assert server._diagnostics_result_id(document) == result_id
+
+        settings = {"plugins": {**settings["plugins"], "pyflakes": {"enabled": False}}}
+        server.m_workspace__did_change_configuration(settings=settings)
+        assert server._diagnostics_result_id(document) != result_id
+    finally:
+        server.m_shutdown()
+
+
+def test_resumed_session_keeps_artifacts(tmp_path, monkeypatch):
+    builds = []
+    build_index = _patch_api._build_index
+
+    def counted_build_index(data):
+        builds.append(data)
+        return build_index(data)
+
+    monkeypatch.setattr(_patch_api, "_build_index", counted_build_index)
+    store = _sessions.SessionStore(directory=str(tmp_path / "sessions"))
+    first, _document = _server(tmp_path, session_store=store)
+    first.m_workspace__did_change_configuration(settings={"apiData": API_DATA})
+    key = _patch_api.api_index_key(first.workspace._config)
+    first.close()
+    assert SHARED.refcount(key) == 1
+
+    second = PythonLSPServer(
+        None, None, consumer=lambda _message: None, session_store=store
+    )
+    result = second.m_initialize(
+        processId=None,
+        rootUri=uris.from_fs_path(str(tmp_path)),
+        initializationOptions={"resumeToken": first.session_token},
+    )
+    try:
+        assert result["resumed"]
+        assert SHARED.refcount(key) == 1
+        assert "move" in _patch_api.api_index(second.workspace._config)
+        assert len(builds) == 1
+    finally:
+        second.close()
+
+
+def test_sessions_keep_their_jedi_trees(tmp_path):
+    first, first_document = _server(tmp_path, "import os\nos.pa")
+    second, second_document = _server(tmp_path, "import sys\nsys.pa")
+    sessions = ((first, first_document), (second, second_document))
+    position = {"line": 1, "character": 5}
+    try:
+        # In turns, so that each session finds the tree of the other cached
+        for _ in range(2):
+            for server, document in sessions:
+                completions = server.completions(document.uri, position)
+                labels = [item["label"] for item in completions["items"]]
+                assert ("pathsep" in labels) == (document is first_document)
+                assert ("path_hooks" in labels) == (document is second_document)
+        estimate = first_document.memory_estimate()
+        second_document.shed_caches()
+        assert first_document.memory_estimate() == estimate
+        assert second_document.memory_estimate() < estimate
+    finally:
+        first.m_shutdown()
+        second.m_shutdown()
+
+
+def test_sessions_lint_the_same_uri(tmp_path):
+    published = {}
+    servers = []
+    for name in ("first", "second"):
+        messages = published.setdefault(name, [])
+        server, document = _server(tmp_path, consumer=messages.append)
+        server.lint(document.uri, is_saved=False)
+        servers.append(server)
+    try:
+        deadline = time.monotonic() + 10
+        while not all(published.values()) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        for messages in published.values():
+            assert messages[0]["method"] == "textDocument/publishDiagnostics"
+    finally:
+        for server in servers:
+            server.m_shutdown()
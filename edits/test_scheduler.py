@@ -0,0 +1,42 @@
+# Copyright 2021- Python Language Server Contributors.
+
+import threading
+import time
+
+from pylsp import _scheduler
+
+
+def test_background_job_yields_once():
+    scheduler = _scheduler.Scheduler(workers=2)
+    started = threading.Event()
+    release = threading.Event()
+
+    def interactive():
+        started.set()
+        release.wait(5)
+
+    def lint():
+        start = time.monotonic()
+        for _ in range(10):
+            scheduler.yield_to_urgent()
+        return time.monotonic() - start
+
+    scheduler.submit("interactive", interactive)
+    started.wait(5)
+    try:
+        paused = scheduler.submit("diagnostics", lint).result(10)
+    finally:
+        release.set()
+    assert _scheduler.MAX_YIELD_S * 0.9 < paused < _scheduler.MAX_YIELD_S * 2
+
+
+def test_interactive_jobs_leave_workers_to_other_classes():
+    scheduler = _scheduler.Scheduler()
+    release = threading.Event()
+    for _ in range(_scheduler.DEFAULT_WORKERS):
+        scheduler.submit("interactive", release.wait, 5)
+    try:
+        assert scheduler.submit("diagnostics", lambda: True).result(2)
+        assert scheduler.submit("workspace", lambda: True).result(2)
+    finally:
+        release.set()
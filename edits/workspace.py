@@ -12,18 +12,49 @@ from threading import RLock
 from typing import Callable, Generator, List, Optional
 
 import jedi
+from jedi.inference.compiled.subprocess import CompiledSubprocess
 
-from . import _utils, lsp, uris
+from . import _jedi_cache, _parse, _patch_api, _utils, lsp, uris
+from ._shared import SHARED, content_key
 
 log = logging.getLogger(__name__)
 
 DEFAULT_AUTO_IMPORT_MODULES = ["numpy"]
 
+# Rough memory held by a cached jedi completion, with its name and signature
+COMPLETION_ESTIMATE_BYTES = 2048
+
 # TODO: this is not the best e.g. we capture numbers
 RE_START_WORD = re.compile("[A-Za-z_0-9]*$")
 RE_END_WORD = re.compile("^[A-Za-z_0-9]*")
 
 
+def _one_request_at_a_time(send):
+    """Let the threads of the server share the subprocess of a jedi environment.
+
+    The subprocess answers one request at a time, over pipes jedi does not
+    lock: requests sent by threads at once read each other's answers, or wait
+    for theirs forever.
+    """
+
+    @functools.wraps(send)
+    def wrapper(self, *args, **kwargs):
+        send_lock = self.__dict__.get("_pylsp_send_lock")
+        if send_lock is None:
+            send_lock = self.__dict__.setdefault("_pylsp_send_lock", RLock())
+        with send_lock:
+            return send(self, *args, **kwargs)
+
+    wrapper.one_request_at_a_time = True
+    return wrapper
+
+
+# pylint: disable=protected-access
+if not getattr(CompiledSubprocess._send, "one_request_at_a_time", False):
+    CompiledSubprocess._send = _one_request_at_a_time(CompiledSubprocess._send)
+# pylint: enable=protected-access
+
+
 def lock(method):
     """Define an atomic region over a method."""
 
@@ -50,8 +81,9 @@ class Workspace:
         self._root_path = uris.to_fs_path(self._root_uri)
         self._docs = {}
 
-        # Cache jedi environments
+        # Cache jedi environments, shared with other sessions by key
         self._environments = {}
+        self._environment_keys = {}
 
         # Whilst incubating, keep rope private
         self.__rope = None
@@ -161,20 +193,19 @@ class Workspace:
         self._docs.pop(doc_uri)
 
     def update_document(self, doc_uri, change, version=None):
-        self._docs[doc_uri].apply_change(change)
-        self._docs[doc_uri].version = version
+        self.update_document_changes(doc_uri, [change], version)
+
+    def update_document_changes(self, doc_uri, changes, version=None):
+        """Apply `changes` at once, so that no snapshot has only part of them."""
+        self._docs[doc_uri].apply_changes(changes, version)
 
     def update_config(self, settings):
-        print("\nWorkspace update_config called with settings:", settings)
-        self._config.update((settings or {}).get("pylsp", {}))
-        self._config.update(settings)
-        for doc_uri in self.documents:
-            document = self.get_document(doc_uri)
-            if isinstance(document, Notebook):
-                # Notebook documents don't have a config. The config is
-                # handled at the cell level.
-                continue
-            document.update_config(settings)
+        """Apply the client settings, returning the keys that changed.
+
+        The documents share the config of the workspace, so it is updated once
+        for all of them.
+        """
+        return self._config.update(settings or {})
 
     def apply_edit(self, edit):
         return self._endpoint.request(self.M_APPLY_EDIT, {"edit": edit})
@@ -375,9 +406,28 @@ class Workspace:
             rope_project_builder=self._rope_project_builder,
         )
 
+    def shed_caches(self):
+        """Drop what is cached for the workspace; it is rebuilt when needed."""
+        for document in list(self._docs.values()):
+            if isinstance(document, Document):
+                document.shed_caches()
+        _patch_api.release(self._config)
+
+    def memory_estimate(self):
+        """Estimate the bytes held by the documents of the workspace."""
+        return sum(
+            document.memory_estimate()
+            for document in list(self._docs.values())
+            if isinstance(document, Document)
+        )
+
     def close(self):
         if self.__rope_autoimport:
             self.__rope_autoimport.close()
+        while self._environment_keys:
+            _path, key = self._environment_keys.popitem()
+            SHARED.release(key)
+        self._environments.clear()
 
 
 class Document:
@@ -392,7 +442,6 @@ class Document:
         rope_project_builder=None,
     ):
         self.uri = uri
-        self.version = version
         self.path = uris.to_fs_path(uri)
         self.dot_path = _utils.path_to_dot_name(self.path)
         self.filename = os.path.basename(self.path)
@@ -401,14 +450,48 @@ class Document:
         self._config = workspace._config
         self._workspace = workspace
         self._local = local
-        self._source = source
+        # Current version of the source, replaced as a whole on each change.
+        # None for documents read from disk.
+        self._snapshot = None if source is None else _parse.Snapshot(source, version)
+        self._disk_version = version
         self._extra_sys_path = extra_sys_path or []
         self._rope_project_builder = rope_project_builder
+        # Held by the writers of the snapshot only, readers never wait for it
         self._lock = RLock()
+        # Jedi's trees of the document in this session, by grammar, kept out of
+        # parso's cache except while the session uses them. See `jedi_inference`.
+        self._jedi_trees = {}
+        self._jedi_depth = 0
 
     def __str__(self):
         return str(self.uri)
 
+    @lock
+    def shed_caches(self):
+        """Drop what is cached for the document; it is rebuilt when needed."""
+        snapshot = self._snapshot
+        if snapshot is not None:
+            self._snapshot = _parse.Snapshot(snapshot.source, snapshot.version)
+        self.shared_data.clear()
+        self._jedi_trees = {}
+
+    def memory_estimate(self):
+        """Estimate the bytes held by the document and its cached data.
+
+        The source, its lines and trees, the tree jedi keeps of it and the
+        cached completions are counted, each completion for
+        `COMPLETION_ESTIMATE_BYTES`.
+        """
+        snapshot = self._snapshot
+        size = snapshot.memory_estimate() if snapshot is not None else 0
+        size += _parse.jedi_trees_estimate(self._jedi_trees)
+        completions = len(self.shared_data.get("LAST_JEDI_COMPLETIONS") or ())
+        warm = self.shared_data.get("WARM_JEDI_COMPLETIONS") or {}
+        for future in list(warm.values()):
+            if future.done() and not future.cancelled() and not future.exception():
+                completions += len(future.result())
+        return size + completions * COMPLETION_ESTIMATE_BYTES
+
     def _rope_resource(self, rope_config):
         from rope.base import libutils
 
@@ -416,67 +499,59 @@ class Document:
             self._rope_project_builder(rope_config), self.path
         )
 
+    def snapshot(self):
+        """Return the immutable snapshot of the current version of the document."""
+        snapshot = self._snapshot
+        if snapshot is None:
+            # Read from disk, which may change anytime
+            with io.open(self.path, "r", encoding="utf-8") as f:
+                return _parse.Snapshot(f.read(), self._disk_version)
+        return snapshot
+
     @property
+    def version(self):
+        snapshot = self._snapshot
+        return self._disk_version if snapshot is None else snapshot.version
+
+    @version.setter
     @lock
+    def version(self, version):
+        snapshot = self._snapshot
+        if snapshot is None:
+            self._disk_version = version
+        elif snapshot.version != version:
+            self._snapshot = _parse.Snapshot(snapshot.source, version)
+
+    @property
     def lines(self):
-        return self.source.splitlines(True)
+        return self.snapshot().lines
 
     @property
-    @lock
     def source(self):
-        if self._source is None:
-            with io.open(self.path, "r", encoding="utf-8") as f:
-                return f.read()
-        return self._source
+        return self.snapshot().source
 
     def update_config(self, settings):
-        print("\nDocument update_config called with settings:", settings)
-        self._config.update((settings).get("pylsp", {}))
-        self._config.update(settings)
+        return self._config.update(settings or {})
 
-    @lock
-    def apply_change(self, change):
+    def apply_change(self, change, version=None):
         """Apply a change to the document."""
-        text = change["text"]
-        change_range = change.get("range")
-
-        if not change_range:
-            # The whole file has changed
-            self._source = text
-            return
-
-        start_line = change_range["start"]["line"]
-        start_col = change_range["start"]["character"]
-        end_line = change_range["end"]["line"]
-        end_col = change_range["end"]["character"]
-
-        # Check for an edit occuring at the very end of the file
-        if start_line == len(self.lines):
-            self._source = self.source + text
-            return
+        self.apply_changes([change], version)
 
-        new = io.StringIO()
-
-        # Iterate over the existing document until we hit the edit range,
-        # at which point we write the new text, then loop until we hit
-        # the end of the range and continue writing.
-        for i, line in enumerate(self.lines):
-            if i < start_line:
-                new.write(line)
-                continue
-
-            if i > end_line:
-                new.write(line)
-                continue
-
-            if i == start_line:
-                new.write(line[:start_col])
-                new.write(text)
-
-            if i == end_line:
-                new.write(line[end_col:])
+    @lock
+    def apply_changes(self, changes, version=None):
+        """Apply `changes` in order, publishing one snapshot at `version`.
 
-        self._source = new.getvalue()
+        The document keeps its version if `version` is None.
+        """
+        previous = self.snapshot()
+        source, lines = previous.source, previous.lines
+        for change in changes:
+            source = _apply_change(source, lines, change)
+            lines = None
+        if version is None:
+            version = previous.version
+        self._snapshot = _parse.Snapshot(source, version)
+        previous.retire()
 
     def offset_at_position(self, position):
         """Return the byte-offset pointed at by the given position."""
@@ -500,18 +575,52 @@ class Document:
 
         return m_start[0] + m_end[-1]
 
-    @lock
+    @contextmanager
+    def jedi_inference(self):
+        """Hold the path of the document for jedi while a request uses it.
+
+        Jedi finds its tree of the document in parso's cache by path, and
+        creating a script updates it in place, which inference must not see
+        change under it. Sessions opening a document of the same path take
+        turns, each with its own tree in the cache. Background inference
+        runs on detached scripts instead, without holding this.
+        """
+        with _parse.jedi_path_lock(self.path):
+            if not self._jedi_depth:
+                _parse.put_jedi_trees(self.path, self._jedi_trees)
+            self._jedi_depth += 1
+            try:
+                yield
+            finally:
+                self._jedi_depth -= 1
+                if not self._jedi_depth:
+                    self._jedi_trees = _parse.take_jedi_trees(self.path)
+
     def jedi_names(self, all_scopes=False, definitions=True, references=False):
-        script = self.jedi_script()
-        return script.get_names(
-            all_scopes=all_scopes, definitions=definitions, references=references
-        )
+        with self.jedi_inference():
+            script = self.jedi_script()
+            return script.get_names(
+                all_scopes=all_scopes, definitions=definitions, references=references
+            )
 
-    @lock
-    def jedi_script(self, position=None, use_document_path=False):
+    def jedi_script(
+        self,
+        position=None,
+        use_document_path=False,
+        use_patch_api=True,
+        snapshot=None,
+        detached=False,
+    ):
+        """Return a jedi script of `snapshot`, by default the current one.
+
+        A `detached` script infers on a tree of its snapshot rather than the
+        one jedi updates as the document changes, so that it may run in the
+        background, past the request creating it.
+        """
         extra_paths = []
         environment_path = None
         env_vars = None
+        patch_api_path = None
 
         if self._config:
             jedi_settings = self._config.plugin_settings(
@@ -520,6 +629,12 @@ class Document:
             jedi.settings.auto_import_modules = jedi_settings.get(
                 "auto_import_modules", DEFAULT_AUTO_IMPORT_MODULES
             )
+            _jedi_cache.use(
+                jedi_settings.get("cache_directory"),
+                jedi_settings.get(
+                    "prebuilt_cache_directory", _jedi_cache.DEFAULT_PREBUILT_DIR
+                ),
+            )
             environment_path = jedi_settings.get("environment")
             # Jedi itself cannot deal with homedir-relative paths.
             # On systems, where it is expected, expand the home directory.
@@ -529,6 +644,9 @@ class Document:
             extra_paths = jedi_settings.get("extra_paths") or []
             env_vars = jedi_settings.get("env_vars")
 
+            if use_patch_api:
+                patch_api_path = _patch_api.stub_path(self._config)
+
         # Drop PYTHONPATH from env_vars before creating the environment because that makes
         # Jedi throw an error.
         if env_vars is None:
@@ -547,8 +665,15 @@ class Document:
         if use_document_path:
             sys_path += [os.path.normpath(os.path.dirname(self.path))]
 
+        if snapshot is None:
+            snapshot = self.snapshot()
+        code = snapshot.source
+        # Make the Patch API functions resolvable by jedi through their stub
+        if patch_api_path:
+            sys_path.insert(0, patch_api_path)
+            code += _patch_api.import_suffix(code)
+
         kwargs = {
-            "code": self.source,
             "path": self.path,
             "environment": environment,
             "project": jedi.Project(path=project_path, sys_path=sys_path),
@@ -558,7 +683,11 @@ class Document:
             # Deprecated by Jedi to use in Script() constructor
             kwargs += _utils.position_to_jedi_linecolumn(self, position)
 
-        return jedi.Script(**kwargs)
+        if detached:
+            return snapshot.detached_jedi_script(code, **kwargs)
+        snapshot.note_jedi_parse()
+        with self.jedi_inference():
+            return jedi.Script(code=code, **kwargs)
 
     def get_enviroment(self, environment_path=None, env_vars=None):
         # TODO(gatesn): #339 - make better use of jedi environments, they seem pretty powerful
@@ -568,10 +697,15 @@ class Document:
             if environment_path in self._workspace._environments:
                 environment = self._workspace._environments[environment_path]
             else:
-                environment = jedi.api.environment.create_environment(
-                    path=environment_path, safe=False, env_vars=env_vars
+                key = content_key("jedi_environment", [environment_path, env_vars])
+                environment = SHARED.acquire(
+                    key,
+                    lambda: jedi.api.environment.create_environment(
+                        path=environment_path, safe=False, env_vars=env_vars
+                    ),
                 )
                 self._workspace._environments[environment_path] = environment
+                self._workspace._environment_keys[environment_path] = key
 
         return environment
 
@@ -586,6 +720,50 @@ class Document:
         return path
 
 
+def _apply_change(source, lines, change):
+    """Return `source` once `change` is applied to it, given its `lines` if split."""
+    text = change["text"]
+    change_range = change.get("range")
+
+    if not change_range:
+        # The whole file has changed
+        return text
+
+    start_line = change_range["start"]["line"]
+    start_col = change_range["start"]["character"]
+    end_line = change_range["end"]["line"]
+    end_col = change_range["end"]["character"]
+
+    if lines is None:
+        lines = source.splitlines(True)
+    # Check for an edit occuring at the very end of the file
+    if start_line == len(lines):
+        return source + text
+
+    new = io.StringIO()
+
+    # Iterate over the existing document until we hit the edit range,
+    # at which point we write the new text, then loop until we hit
+    # the end of the range and continue writing.
+    for i, line in enumerate(lines):
+        if i < start_line:
+            new.write(line)
+            continue
+
+        if i > end_line:
+            new.write(line)
+            continue
+
+        if i == start_line:
+            new.write(line[:start_col])
+            new.write(text)
+
+        if i == end_line:
+            new.write(line[end_col:])
+
+    return new.getvalue()
+
+
 class Notebook:
     """Represents a notebook."""
 